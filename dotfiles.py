@@ -1,8 +1,29 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import dotlib
 
+# color names
+SOLARIZED = dict(
+    base02='#073642',
+    red='#dc322f',
+    green='#859900',
+    yellow='#b58900',
+    blue='#268bd2',
+    magenta='#d33682',
+    cyan='#2aa198',
+    base2='#eee8d5',
+    base03='#002b36',
+    orange='#cb4b16',
+    base01='#586e75',
+    base00='#657b83',
+    base0='#839496',
+    violet='#6c71c4',
+    base1='#93a1a1',
+    base3='#fdf6e3'
+)
+
 def get_data():
     """get my settings"""
     data = dotlib.Data()
@@ -26,38 +47,6 @@ def get_data():
     #     brcyan='base1',
     #     brwhite='base3'
 
-    # color names
-    #     base02='#073642',
-    #     red='#dc322f',
-    #     green='#859900',
-    #     yellow='#b58900',
-    #     blue='#268bd2',
-    #     magenta='#d33682',
-    #     cyan='#2aa198',
-    #     base2='#eee8d5',
-    #     base03='#002b36',
-    #     orange='#cb4b16',
-    #     base01='#586e75',
-    #     base00='#657b83',
-    #     base0='#839496',
-    #     violet='#6c71c4',
-    #     base1='#93a1a1',
-    #     base3='#fdf6e3'
-
-    # material colors
-    # source: https://material.io/design/color/#color-theme-creation
-    #     # primary main/variant, secondary main/variant, error main
-    #     mat_prim='#6200EE',
-    #     mat_priv='#3700B3',
-    #     mat_secm='#03DAC6',
-    #     mat_secv='#018786',
-    #     mat_errm='#B00020',
-    #     # on primary, on secondary, on error
-    #     mat_opri='#FFFFFF',
-    #     mat_osec='#000000',
-    #     mat_oerr='#FFFFFF',
-    #     junk='#FFFF00'
-
     general = ['general']
     arch = ['arch']
     zsh = ['zsh']
@@ -76,19 +65,19 @@ def get_data():
     data.add_file(general, 'vimrc', '.vimrc')
     data.add_file(zsh, 'zshrc', '.zshrc')
     data.add_dir(
-        dotlib.Dir(arch, 'kitty', '.config/kitty')
+        dotlib.Dir(arch, 'kitty', '.config/kitty', hook='kitty')
         .file('kitty.conf')
-        .file('kitty-solarized-light.conf')
+        .template('kitty-solarized-light.conf', SOLARIZED)
     )
-    data.add_file(arch, 'xresources', '.Xresources')
+    data.add_template(arch, 'xresources.template', '.Xresources', SOLARIZED, hook='xresources')
     data.add_file(arch, 'powermate.toml', '.config/powermate.toml')
     data.add_file(arch, 'ranger.conf', '.config/ranger/rc.conf')
-    # data.add_file(arch, 'termite.conf', '.config/termite/config') # no longer used
+    # data.add_file(arch, 'termite.conf', '.config/termite/config', hook='termite') # no longer used
     data.add_file(arch, 'fonts.conf', '.config/fontconfig/fonts.conf')
     # data.add_file(arch, 'i3config', '.config/i3/config')
-    data.add_file(arch, 'i3config_clean', '.config/i3/config')
+    data.add_file(arch, 'i3config_clean', '.config/i3/config', hook='i3')
     data.add_file(win, 'minttyrc', '.minttyrc')
-    data.add_file(arch, 'dunst.cfg', '.config/dunst.cfg')
+    data.add_file(arch, 'dunst.cfg', '.config/dunst.cfg', hook='dunst')
     data.add_file(arch, 'i3blocks-config', '.config/i3blocks/config')
     data.add_dir(
         dotlib.Dir(arch, "i3blocks-scripts", ".config/i3blocks/scripts")
@@ -109,7 +98,8 @@ def get_data():
     data.add_dir(
         dotlib.Dir(code, "vs_code", ".config/{}/User"
             .format('Code - OSS' if dotlib.has_class('arch') else 'Code'),
-                   win_where=dotlib.PathType.APPDATA_ROAMING, win_home='Code' + os.path.sep + 'User', osx_home='Library/Application Support/Code/User')
+                   win_where=dotlib.PathType.APPDATA_ROAMING, win_home='Code' + os.path.sep + 'User', osx_home='Library/Application Support/Code/User',
+                   compare='json')
         .file('keybindings.json')
         .file('settings.json')
     )
@@ -142,7 +132,7 @@ def get_data():
         .file('pathogen.vim')
         .set_dir('after/ftplugin')
         .file('proto.vim')
-        .add_dir('bundle/syntastic/')
+        .add_submodule('bundle/syntastic/')
     )
     data.add_file(win, 'powershell.ps1', 'Documents/PowerShell/Microsoft.PowerShell_profile.ps1')
 
@@ -150,16 +140,19 @@ def get_data():
         # determine terminal name
         containing_folder_type = dotlib.PathType.APPDATA_LOCAL
         containing_folder = os.path.join(dotlib.get_folder(containing_folder_type), 'Packages')
+        # a terminal that is installed, updated or removed changes the package folders
+        data.add_scanned_folder(containing_folder)
         all_dirs = get_all_dirs(containing_folder)
         dirs = [d for d in all_dirs if 'Microsoft.WindowsTerminal' in d]
         if len(dirs) == 1:
             terminal_name = dirs[0].split(os.path.sep)[-1]
-            print(f'Found terminal name: {terminal_name}')
-            # todo(Gustav): add ignore sections/keys
+            # stderr so the output of status --json and --porcelain stays clean
+            print(f'Found terminal name: {terminal_name}', file=sys.stderr)
+            # the terminal writes the settings back with its own formatting and links
             data.add_file_path(win, 'windows-terminal.json', f'Packages/{terminal_name}/LocalState/settings.json',
-                            containing_folder_type)
+                            containing_folder_type, compare='json', ignore=['$help', '$schema'])
         else:
-            print(f'Error: found {len(dirs)} terminal folders: {dirs}')
+            print(f'Error: found {len(dirs)} terminal folders: {dirs}', file=sys.stderr)
 
     return data
 
@@ -170,4 +163,4 @@ def get_all_dirs(d):
 
 
 if __name__ == "__main__":
-    dotlib.main(get_data())
+    dotlib.main(get_data)
@@ -1,20 +1,24 @@
 #!/usr/bin/env python3
 
+# only modules that every command needs are imported here, the rest are imported where they are used
+# so that a plain status or class from a shell hook starts fast, see tests/check_startup.py
 import argparse
 import os
-import filecmp
-import subprocess
-import shutil
 import sys
-import platform
+import signal
+import stat
 import typing
 import json
 import time
-import collections
+import functools
+import fnmatch
+import re
+import io
+import itertools
+import threading
+import contextlib
 from enum import Enum
 
-from external.prettygood.config import *
-
 # removed
 # generate_file
 # file_generate
@@ -25,10 +29,65 @@ from external.prettygood.config import *
 
 # to be removed
 
-SETTINGS_CLASS = Settings('class', [])
+@functools.lru_cache(maxsize=None)
+def get_class_setting():
+    from external.prettygood.config import Settings
+    return Settings('class', [])
+
 
+class Profiler:
+    """Wall time and counts per phase, and with tracing one event per file operation"""
 
-def get_config() -> Config:
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def start(self, tracing: bool):
+        self.enabled = True
+        self.tracing = tracing
+        self.started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name: str, path: typing.Optional[str] = None):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                count, total = self.phases.get(name, (0, 0.0))
+                self.phases[name] = (count + 1, total + elapsed)
+                if self.tracing:
+                    self.events.append({'phase': name, 'path': path, 'start': start - self.started,
+                                        'seconds': elapsed, 'thread': threading.get_ident()})
+
+    def write_trace(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            for event in self.events:
+                f.write(json.dumps(event))
+                f.write('\n')
+
+    def print_summary(self, out=sys.stderr):
+        wall = time.perf_counter() - self.started
+        out.write('{:<14} {:>8} {:>12} {:>10} {:>7}\n'.format('phase', 'count', 'total ms', 'mean ms', 'wall'))
+        for name, (count, total) in sorted(self.phases.items(), key=lambda p: -p[1][1]):
+            out.write('{:<14} {:>8} {:>12.2f} {:>10.3f} {:>6.1f}%\n'.format(
+                name, count, total * 1000, total * 1000 / count, 100 * total / wall if wall > 0 else 0))
+        out.write('{:<14} {:>8} {:>12.2f}\n'.format('wall', '', wall * 1000))
+
+
+PROFILER = Profiler()
+
+
+def get_config():
+    from external.prettygood.config import get_user_data
     return get_user_data('dotlib')
 
 
@@ -56,8 +115,10 @@ def get_home_folder() -> str:
     return os.path.expanduser('~')
 
 
+@functools.lru_cache(maxsize=None)
 def get_appdata_roaming_folder() -> str:
     if has_class('wsl'):
+        import subprocess
         user = subprocess.check_output(['cmd.exe', '/c', 'echo', '%username%'], text=True).strip()
         print(user)
         appdata = '/mnt/c/Users/{}/Appdata/Roaming'.format(user)
@@ -69,12 +130,21 @@ def get_src_folder() -> str:
     return os.path.dirname(os.path.abspath(__file__))
 
 
+def get_cache_folder() -> str:
+    xdg = os.getenv('XDG_CACHE_HOME')
+    if xdg:
+        return os.path.join(xdg, 'dotlib')
+    if sys.platform == 'win32' and os.getenv('LOCALAPPDATA'):
+        return os.path.join(os.getenv('LOCALAPPDATA'), 'dotlib')
+    return os.path.join(get_home_folder(), '.cache', 'dotlib')
+
+
 def is_windows() -> bool:
-    return has_class('wsl') or platform.system() == 'Windows'
+    return has_class('wsl') or sys.platform == 'win32'
 
 
 def is_osx() -> bool:
-    return platform.system() == 'Darwin'
+    return sys.platform == 'darwin'
 
 
 class PathType(Enum):
@@ -92,28 +162,75 @@ def get_folder(path: PathType) -> str:
     return get_home_folder()
 
 
-def is_running(app: str) -> bool:
-    try:
-        import psutil
-        return app in (p.name() for p in psutil.process_iter())
-    except ModuleNotFoundError:
-        print('psutil not found, try pip install psutil')
-        return False
+def get_running_processes() -> typing.Dict[str, typing.List[int]]:
+    """process name to pids, read from /proc where it exists and from psutil elsewhere"""
+    processes = {}
+    with PROFILER.phase('process scan'):
+        if os.path.isdir('/proc'):
+            for pid in os.listdir('/proc'):
+                if not pid.isdigit():
+                    continue
+                try:
+                    with open(os.path.join('/proc', pid, 'comm'), 'r', encoding='utf-8', errors='replace') as f:
+                        processes.setdefault(f.read().strip(), []).append(int(pid))
+                except OSError:
+                    # the process exited while we were looking
+                    pass
+            return processes
+        try:
+            import psutil
+            for p in psutil.process_iter(['name']):
+                processes.setdefault(p.info['name'], []).append(p.pid)
+        except ModuleNotFoundError:
+            print('psutil not found, try pip install psutil')
+    return processes
+
+
+class ClassTable:
+    """Interns class names as bits so the classes of a file are a single int"""
+
+    def __init__(self):
+        self.ids = {}
+        self.names = {}
+
+    def get_mask(self, classes: typing.Union[int, typing.Iterable[str]]) -> int:
+        if isinstance(classes, int):
+            return classes
+        mask = 0
+        for c in classes:
+            bit = self.ids.get(c)
+            if bit is None:
+                bit = self.ids[c] = 1 << len(self.ids)
+            mask |= bit
+        return mask
+
+    def get_names(self, mask: int) -> typing.List[str]:
+        """the classes in mask, every file with the same classes shares the list"""
+        names = self.names.get(mask)
+        if names is None:
+            names = self.names[mask] = [c for c, bit in self.ids.items() if mask & bit]
+        return names
+
+
+CLASSES = ClassTable()
 
 
 class VarPath:
+    # the folders are shared by every file in a Dir, the path is only joined when asked for
+    __slots__ = ('base', 'subdir', 'name', 'win_where')
+
     def __init__(self, base: typing.Optional[str], path: str, subdir: typing.Optional[str], win_where: PathType):
+        self.base = base
+        self.subdir = subdir
+        self.name = path
         self.win_where = win_where
-        if base is None:
-            if subdir is None:
-                self.path = path
-            else:
-                self.path = os.path.join(subdir, path)
-        else:
-            if subdir is None:
-                self.path = os.path.join(base, path)
-            else:
-                self.path = os.path.join(base, subdir, path)
+
+    @property
+    def path(self) -> str:
+        return os.path.join(*self.get_folders(), self.name)
+
+    def get_folders(self) -> typing.Tuple[str, ...]:
+        return tuple(f for f in (self.base, self.subdir) if f is not None)
 
     def get_abs_path(self) -> str:
         base_path = get_folder(self.win_where) if is_windows() else get_home_folder()
@@ -121,15 +238,248 @@ class VarPath:
 
 
 class Path:
-    def __init__(self, classes: typing.List[str], src: str, home: VarPath):
-        self.classes = classes
+    __slots__ = ('mask', 'src_folder', 'src_name', 'home', 'hook', 'variables', 'compare', 'submodule')
+
+    def __init__(self, classes: typing.Union[int, typing.List[str]], src: str, home: VarPath,
+                 hook: typing.Optional[str] = None, variables: typing.Optional[typing.Dict[str, str]] = None,
+                 compare: typing.Optional[typing.List] = None, src_folder: str = '', submodule: bool = False):
+        # see ClassTable
+        self.mask = CLASSES.get_mask(classes)
+        # src is relative to src_folder, shared by every file in a Dir
+        self.src_folder = src_folder
+        self.src_name = src
         self.home = home
+        self.hook = hook
+        # set for templates, src is then rendered with these before it is installed
+        self.variables = variables
+        # [kind, ignored key paths] when the files are compared by their parsed content, see get_compare()
+        self.compare = compare
+        # src_folder is a git submodule that is installed from its committed tree, see Dir.add_submodule()
+        self.submodule = submodule
+
+    @property
+    def classes(self) -> typing.List[str]:
+        return CLASSES.get_names(self.mask)
+
+    @property
+    def src(self) -> str:
+        return os.path.join(self.src_folder, self.src_name)
+
+
+def get_compare(compare: typing.Optional[str], ignore: typing.Optional[typing.List[str]]) -> typing.Optional[typing.List]:
+    """
+    compare='json' compares json, with comments, by content so whitespace and key order don't count.
+    ignore lists key paths that may differ, separated by / with * matching any key or index.
+    """
+    if compare is None:
+        return None
+    if compare not in COMPARE_FUNCTIONS:
+        raise ValueError('Unknown comparison {}, expected one of {}'.format(compare, ', '.join(COMPARE_FUNCTIONS)))
+    return [compare, ignore if ignore is not None else []]
+
+
+class Hook:
+    """
+    What to do when an installed file has changed: send a signal to, or run a command for, the listed processes.
+    Without processes the command always runs, {file} in the command is replaced with each changed file.
+    """
+
+    def __init__(self, processes: typing.List[str], command: typing.Optional[typing.List[str]] = None,
+                 signal_number: typing.Optional[int] = None):
+        self.processes = processes
+        self.command = command
+        self.signal_number = signal_number
+
+    def get_pids(self, running: typing.Dict[str, typing.List[int]]) -> typing.List[int]:
+        return [pid for p in self.processes for pid in running.get(p, [])]
+
+    def is_needed(self, running: typing.Dict[str, typing.List[int]]) -> bool:
+        return len(self.processes) == 0 or len(self.get_pids(running)) > 0
+
+    def run(self, files: typing.List[str], running: typing.Dict[str, typing.List[int]]):
+        pids = self.get_pids(running)
+        if self.signal_number is not None:
+            for pid in pids:
+                os.kill(pid, self.signal_number)
+        if self.command is not None:
+            commands = [[a.replace('{file}', f) for a in self.command] for f in files] \
+                if any('{file}' in a for a in self.command) else [self.command]
+            import subprocess
+            for command in commands:
+                result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+                if result.stdout.strip() != '':
+                    print(result.stdout.rstrip())
+
+
+HOOKS = {
+    'termite': Hook(['termite'], signal_number=getattr(signal, 'SIGUSR1', None)),
+    'kitty': Hook(['kitty'], signal_number=getattr(signal, 'SIGUSR1', None)),
+    'xresources': Hook([], ['xrdb', '-merge', '{file}']),
+    'i3': Hook(['i3'], ['i3-msg', 'reload']),
+    # dunst is started again by dbus on the next notification
+    'dunst': Hook(['dunst'], signal_number=signal.SIGTERM),
+}
+
+
+def run_hooks(changed: typing.Dict[str, typing.List[str]], jobs: int = 1):
+    """run the hooks of the changed files, changed maps hook name to the installed files"""
+    if len(changed) == 0:
+        return
+    running = get_running_processes()
+
+    def run(name: str):
+        hook = HOOKS.get(name)
+        if hook is None:
+            print('Unknown hook', name)
+            return
+        if not hook.is_needed(running):
+            return
+        print('Running hook', name)
+        with PROFILER.phase('hook', name):
+            try:
+                hook.run(changed[name], running)
+            except OSError as e:
+                print('Hook', name, 'failed:', e)
+
+    # hooks are independent of each other, run them all at once
+    run_in_plan_order(max(jobs, len(changed)), [lambda n=name: run(n) for name in sorted(changed)])
+
+
+class IgnoreRules:
+    """
+    .gitignore style patterns: a pattern with a slash is anchored to the folder it was read from,
+    otherwise it matches a name at any depth. A trailing slash only matches folders, ** matches
+    any number of folders and a leading ! includes what an earlier pattern excluded.
+    """
+
+    def __init__(self):
+        self.rules = []
+
+    @staticmethod
+    def translate(pattern: str) -> str:
+        regex = ''
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+            elif pattern.startswith('**', i):
+                regex += '.*'
+                i += 2
+            elif pattern[i] == '*':
+                regex += '[^/]*'
+                i += 1
+            elif pattern[i] == '?':
+                regex += '[^/]'
+                i += 1
+            elif pattern[i] == '[':
+                end = pattern.find(']', i + 1)
+                if end == -1:
+                    regex += re.escape('[')
+                    i += 1
+                else:
+                    regex += fnmatch.translate(pattern[i:end + 1])[4:-3]
+                    i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        return regex
+
+    def add(self, pattern: str, base: str = ''):
+        pattern = pattern.rstrip('\n').rstrip()
+        if pattern == '' or pattern.startswith('#'):
+            return
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        regex = IgnoreRules.translate(pattern)
+        if base != '':
+            regex = re.escape(base + '/') + ('' if anchored else '(?:.*/)?') + regex
+        elif not anchored:
+            regex = '(?:.*/)?' + regex
+        self.rules.append((re.compile(regex + '$'), negate, dir_only))
+
+    def add_file(self, path: str, base: str):
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                self.add(line, base)
+
+    def is_ignored(self, relative: str, is_dir: bool) -> bool:
+        ignored = False
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative):
+                ignored = not negate
+        return ignored
+
+
+class ScannedDir:
+    """A folder registered with Dir.add_dir(), only walked when a plan needs its files"""
+
+    def __init__(self, classes: typing.List[str], src: str, home: str, subdir: str, win_where: PathType,
+                 exclude: typing.List[str], hook: typing.Optional[str] = None,
+                 compare: typing.Optional[typing.List] = None, submodule: bool = False):
+        self.mask = CLASSES.get_mask(classes)
+        self.submodule = submodule
+        self.hook = hook
+        self.compare = compare
         self.src = src
+        self.home = home
+        self.subdir = os.path.normpath(subdir)
+        self.win_where = win_where
+        self.exclude = exclude
+
+    def expand(self, scanned_dirs: typing.Dict[str, int], scanned_files: typing.Dict[str, int]) -> typing.List[Path]:
+        root = os.path.join(get_src_folder(), self.src, self.subdir)
+        rules = IgnoreRules()
+        for pattern in self.exclude:
+            rules.add(pattern)
+        files = []
+        src_folder = os.path.join(self.src, self.subdir)
+        # depth first with sorted entries so the plan order does not depend on the filesystem
+        stack = ['']
+        while len(stack) > 0:
+            relative = stack.pop()
+            folder = os.path.join(root, relative) if relative != '' else root
+            folder = os.path.normpath(folder)
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda e: e.name)
+            scanned_dirs[folder] = os.stat(folder).st_mtime_ns
+            for entry in entries:
+                if entry.name == '.gitignore' and entry.is_file():
+                    rules.add_file(entry.path, relative)
+                    scanned_files[entry.path] = entry.stat().st_mtime_ns
+            subdirs = []
+            for entry in entries:
+                if entry.name == '.git':
+                    continue
+                name = entry.name if relative == '' else relative + '/' + entry.name
+                # dirent type info, no stat unless it is a symlink
+                is_dir = entry.is_dir()
+                if rules.is_ignored(name, is_dir):
+                    continue
+                if is_dir:
+                    subdirs.append(name)
+                else:
+                    path = name.replace('/', os.sep)
+                    files.append(Path(self.mask, path, VarPath(self.home, path, self.subdir, self.win_where),
+                                      self.hook, None, self.compare, src_folder, self.submodule))
+            stack.extend(reversed(subdirs))
+        return files
 
 
 class Dir:
-    def __init__(self, classes: typing.List[str], src: str, home: str, win_where: PathType = PathType.USER, win_home: typing.Optional[str]=None, osx_home: typing.Optional[str]=None):
+    def __init__(self, classes: typing.List[str], src: str, home: str, win_where: PathType = PathType.USER, win_home: typing.Optional[str]=None, osx_home: typing.Optional[str]=None, hook: typing.Optional[str]=None,
+                 compare: typing.Optional[str] = None, ignore: typing.Optional[typing.List[str]] = None):
         self.classes = classes
+        self.mask = CLASSES.get_mask(classes)
+        self.hook = hook
+        self.compare = get_compare(compare, ignore)
         self.files = []
         self.home = home
         if is_windows() and win_home is not None:
@@ -138,43 +488,48 @@ class Dir:
             self.home = osx_home
         self.src = src
         self.subdir = None
+        # joined once and shared by the files
+        self.src_folder = src
         self.win_where = win_where
 
     def set_dir(self, subdir: str) -> 'Dir':
         self.subdir = subdir
+        self.src_folder = os.path.join(self.src, subdir)
         return self
 
-    def add_dir(self, subdir: str) -> 'Dir':
-        self.add_dir_rec(subdir)
+    def add_dir(self, subdir: str, exclude: typing.Optional[typing.List[str]] = None) -> 'Dir':
+        """add every file below subdir, skipping .git, anything matched by a .gitignore and the exclude patterns"""
+        self.files.append(ScannedDir(self.mask, self.src, self.home, subdir, self.win_where,
+                                     exclude if exclude is not None else [], self.hook, self.compare))
         return self
 
-    def add_dir_rec(self, subdir: str):
-        p = os.path.join(get_src_folder(), self.src, subdir)
-        # work in progress...
-        # todo: traverse all files in subdir and add them to self.files
-        for entry in os.listdir(p):
-            if entry == '.git':
-                pass
-            else:
-                if os.path.isfile(os.path.join(get_src_folder(), self.src, subdir, entry)):
-                    self.files.append(Path(self.classes,
-                        os.path.join(self.src, subdir, entry),
-                        VarPath(self.home, entry, subdir, self.win_where)
-                    ))
-                else:
-                    self.add_dir_rec(os.path.join(subdir, entry))
+    def add_submodule(self, subdir: str, exclude: typing.Optional[typing.List[str]] = None) -> 'Dir':
+        """
+        like add_dir() for a git submodule, install streams the committed tree with git archive
+        and skips the whole folder while the submodule stays at the same commit
+        """
+        self.files.append(ScannedDir(self.mask, self.src, self.home, subdir, self.win_where,
+                                     exclude if exclude is not None else [], self.hook, self.compare, True))
+        return self
 
     def file(self, path: str) -> 'Dir':
-        if self.subdir is None:
-            self.files.append(Path(self.classes,
-                os.path.join(self.src, path),
-                VarPath(self.home, path, None, self.win_where)
-            ))
-        else:
-            self.files.append(Path(self.classes,
-                os.path.join(self.src, self.subdir, path),
-                VarPath(self.home, path, self.subdir, self.win_where)
-            ))
+        self.files.append(Path(self.mask,
+            path,
+            VarPath(self.home, path, self.subdir, self.win_where),
+            self.hook, None, self.compare, self.src_folder
+        ))
+        return self
+
+    def template(self, path: str, variables: typing.Dict[str, str]) -> 'Dir':
+        """install path rendered from path.template, see render_template()"""
+        self.files.append(Path(self.mask,
+            path + TEMPLATE_SUFFIX,
+            VarPath(self.home, path, self.subdir, self.win_where),
+            self.hook,
+            variables,
+            self.compare,
+            self.src_folder
+        ))
         return self
 
 
@@ -184,36 +539,951 @@ class Data:
         return []
 
     def __init__(self):
-        self.interesting_files = Data._empty_files()
+        # files and not yet scanned folders, in the order they were added
+        self.entries = []
+        # folders get_data() listed itself, the plan is rebuilt when one of them changes
+        self.scanned_folders = []
+
+    @property
+    def interesting_files(self) -> typing.List[Path]:
+        files = Data._empty_files()
+        for entry in self.entries:
+            if isinstance(entry, ScannedDir):
+                files.extend(entry.expand({}, {}))
+            else:
+                files.append(entry)
+        return files
+
+    def add_file(self, classes: typing.List[str], src: str, home: str, hook: typing.Optional[str] = None,
+                 compare: typing.Optional[str] = None, ignore: typing.Optional[typing.List[str]] = None):
+        file = Path(classes, src, VarPath(None, home, None, PathType.USER), hook, None, get_compare(compare, ignore))
+        self.entries.append(file)
 
-    def add_file(self, classes: typing.List[str], src: str, home: str):
-        file = Path(classes, src, VarPath(None, home, None, PathType.USER))
-        self.interesting_files.append(file)
+    def add_file_path(self, classes: typing.List[str], src: str, home: str, path: PathType,
+                      hook: typing.Optional[str] = None, compare: typing.Optional[str] = None,
+                      ignore: typing.Optional[typing.List[str]] = None):
+        file = Path(classes, src, VarPath(None, home, None, path), hook, None, get_compare(compare, ignore))
+        self.entries.append(file)
 
-    def add_file_path(self, classes: typing.List[str], src: str, home: str, path: PathType):
-        file = Path(classes, src, VarPath(None, home, None, path))
-        self.interesting_files.append(file)
+    def add_template(self, classes: typing.List[str], src: str, home: str, variables: typing.Dict[str, str],
+                     hook: typing.Optional[str] = None):
+        file = Path(classes, src, VarPath(None, home, None, PathType.USER), hook, variables)
+        self.entries.append(file)
 
     def add_dir(self, subdir: Dir):
         for f in subdir.files:
-            self.interesting_files.append(f)
+            self.entries.append(f)
+
+    def add_scanned_folder(self, folder: str):
+        """call for a folder that get_data() lists to decide what to install"""
+        self.scanned_folders.append(folder)
+
+
+class PlanEntry:
+    """A file with its class filter already evaluated and both sides resolved to absolute paths"""
+    __slots__ = ('src', 'home', 'classes', 'active', 'hook', 'template', 'compare', 'submodule')
+
+    def __init__(self, src: str, home: str, classes: typing.List[str], active: bool, hook: typing.Optional[str],
+                 template: typing.Optional[typing.List] = None, compare: typing.Optional[typing.List] = None,
+                 submodule: typing.Optional[str] = None):
+        self.src = src
+        self.home = home
+        self.classes = classes
+        self.active = active
+        self.hook = hook
+        # [template path, variables] when src is rendered into the cache folder
+        self.template = template
+        # see get_compare()
+        self.compare = compare
+        # the submodule folder src was found in, when it is installed from git, see Dir.add_submodule()
+        self.submodule = submodule
+
+    def get_source(self) -> str:
+        """the file in git, the template for generated files"""
+        return self.template[0] if self.template is not None else self.src
+
+
+class Plan:
+    VERSION = 6
+
+    def __init__(self, entries: typing.List[PlanEntry], classes: typing.Iterable[str],
+                 scanned_dirs: typing.Dict[str, int], scanned_files: typing.Dict[str, int]):
+        self.entries = entries
+        self.classes = frozenset(classes)
+        # folders and ignore files that went into the entries, the cached plan is only valid while they are untouched
+        self.scanned_dirs = scanned_dirs
+        self.scanned_files = scanned_files
+        # how to evaluate the plan again, set by main()
+        self.source = None
+        # the cache key the plan was loaded with, None if it wasn't loaded from get_data
+        self.key = None
+        self.path_index = None
+
+    def index(self) -> 'PathIndex':
+        if self.path_index is None:
+            self.path_index = PathIndex(self.active_entries())
+        return self.path_index
+
+    def reload(self) -> 'Plan':
+        if self.source is None:
+            return self
+        plan = build_plan(self.source) if isinstance(self.source, Data) else load_plan(self.source)
+        plan.source = self.source
+        return plan
+
+    def active_entries(self) -> typing.List[PlanEntry]:
+        return [e for e in self.entries if e.active]
+
+    def rebase(self, root: str) -> 'Plan':
+        """the same plan installing into root instead of HOME, files outside of HOME are left out"""
+        home = get_home_folder()
+        entries = []
+        for e in self.entries:
+            relative = os.path.relpath(e.home, home)
+            if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+                continue
+            entries.append(PlanEntry(e.src, os.path.join(root, relative), e.classes, e.active, e.hook, e.template,
+                                     e.compare, e.submodule))
+        return Plan(entries, self.classes, self.scanned_dirs, self.scanned_files)
+
+    def all_classes(self) -> typing.FrozenSet[str]:
+        return self.classes
+
+    def to_json(self, key: str) -> dict:
+        return {
+            'version': Plan.VERSION,
+            'key': key,
+            'classes': sorted(self.classes),
+            'dirs': self.scanned_dirs,
+            'files': self.scanned_files,
+            'entries': [[e.src, e.home, e.classes, e.active, e.hook, e.template, e.compare, e.submodule]
+                        for e in self.entries]
+        }
+
+    @staticmethod
+    def from_json(loaded: dict, key: str) -> typing.Optional['Plan']:
+        if loaded.get('version') != Plan.VERSION or loaded.get('key') != key:
+            return None
+        dirs = loaded['dirs']
+        files = loaded['files']
+        for p, mtime in itertools.chain(dirs.items(), files.items()):
+            try:
+                if os.stat(p).st_mtime_ns != mtime:
+                    return None
+            except OSError:
+                return None
+        return Plan([PlanEntry(*e) for e in loaded['entries']], loaded['classes'], dirs, files)
+
+
+def build_plan(data: Data, active_classes: typing.Optional[typing.Iterable[str]] = None) -> Plan:
+    if active_classes is None:
+        with PROFILER.phase('classes'):
+            active_classes = get_class_setting().get_value(get_config())
+    active_mask = CLASSES.get_mask(active_classes)
+    src_folder = get_src_folder()
+    windows = is_windows()
+    folders = {}
+    # absolute folders, joined once per Dir and shared by its entries
+    src_folders = {}
+    home_folders = {}
+
+    def base_folder(where: PathType) -> str:
+        if not windows:
+            where = PathType.USER
+        if where not in folders:
+            folders[where] = get_folder(where)
+        return folders[where]
+
+    entries = []
+    all_mask = 0
+    scanned_dirs = {}
+    scanned_files = {}
+
+    def add(file: Path, active: bool):
+        folder = src_folders.get(file.src_folder)
+        if folder is None:
+            folder = src_folders[file.src_folder] = os.path.join(src_folder, file.src_folder)
+        src = os.path.join(folder, file.src_name)
+        key = (file.home.win_where, file.home.base, file.home.subdir)
+        home = home_folders.get(key)
+        if home is None:
+            home = home_folders[key] = os.path.join(base_folder(file.home.win_where), *file.home.get_folders())
+        home = os.path.join(home, file.home.name)
+        template = None
+        if file.variables is not None:
+            template = [src, file.variables]
+            src = get_generated_path(home)
+        entries.append(PlanEntry(src, home, CLASSES.get_names(file.mask), active, file.hook, template, file.compare,
+                                 folder if file.submodule else None))
+
+    for entry in data.entries:
+        all_mask |= entry.mask
+        active = entry.mask & active_mask != 0
+        if isinstance(entry, ScannedDir):
+            # folders for classes that are not used on this machine are never walked
+            if active:
+                with PROFILER.phase('scan', entry.subdir):
+                    for file in entry.expand(scanned_dirs, scanned_files):
+                        add(file, True)
+        else:
+            add(entry, active)
+    for folder in data.scanned_folders:
+        try:
+            scanned_dirs[folder] = os.stat(folder).st_mtime_ns
+        except OSError:
+            pass
+    return Plan(entries, CLASSES.get_names(all_mask), scanned_dirs, scanned_files)
+
+
+def get_plan_cache_key(get_data: typing.Callable[[], Data]) -> str:
+    # stat the sources instead of hashing them, hashlib alone is a noticeable part of startup
+    key = []
+    for source in [sys.modules[get_data.__module__].__file__, __file__]:
+        st = os.stat(source)
+        key.append([os.path.abspath(source), st.st_size, st.st_mtime_ns])
+    key.append(get_class_setting().get_value(get_config()))
+    key.append([sys.platform, get_host_name(), get_src_folder(), get_home_folder()])
+    key.append([os.getenv(env, '') for env in ['APPDATA', 'LOCALAPPDATA', 'USER', 'USERNAME', 'WSL_DISTRO_NAME']])
+    return json.dumps(key)
+
+
+def load_plan(get_data: typing.Callable[[], Data]) -> Plan:
+    """Evaluate get_data() into a plan, or reuse the plan from the last run when nothing it depends on changed"""
+    path = os.path.join(get_cache_folder(), 'plan.json')
+    with PROFILER.phase('plan cache'):
+        key = get_plan_cache_key(get_data)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                cached = Plan.from_json(json.load(f), key)
+            if cached is not None:
+                cached.key = key
+                return cached
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    with PROFILER.phase('get_data'):
+        data = get_data()
+    plan = build_plan(data)
+    plan.key = key
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(plan.to_json(key), f)
+        os.replace(temp, path)
+    except OSError as e:
+        print('Unable to save plan cache', e)
+    return plan
+
+
+TEMPLATE_SUFFIX = '.template'
+# besides the declared variables every template can use {{ host }}, {{ classes }} and {{ platform }}
+TEMPLATE_VARIABLE = re.compile(r'{{\s*([A-Za-z_][A-Za-z0-9_]*)\s*}}')
+
+
+def get_host_name() -> str:
+    if hasattr(os, 'uname'):
+        return os.uname().nodename
+    return os.getenv('COMPUTERNAME', '')
+
+
+def get_generated_path(home: str) -> str:
+    relative = os.path.relpath(home, get_home_folder())
+    if relative == os.pardir or relative.startswith(os.pardir + os.sep) or os.path.isabs(relative):
+        relative = os.path.join('_outside_home', os.path.splitdrive(home)[1].lstrip('\\/'))
+    return os.path.join(get_cache_folder(), 'generated', relative)
+
+
+def get_builtin_template_variables() -> typing.Dict[str, str]:
+    """the variables every template gets, a declared variable with the same name wins"""
+    return {
+        'host': get_host_name(),
+        'classes': ' '.join(sorted(get_class_setting().get_value(get_config()))),
+        'platform': sys.platform,
+    }
+
+
+def render_template(text: str, variables: typing.Dict[str, str]) -> str:
+    """replace {{ name }} with the variable, an unknown name is an error"""
+    def replace(match):
+        name = match.group(1)
+        if name not in variables:
+            raise KeyError(name)
+        return str(variables[name])
+    return TEMPLATE_VARIABLE.sub(replace, text)
+
+
+class TemplateCache:
+    """
+    The inputs every generated file was rendered from: the stat of the template and the variables.
+    Only templates whose inputs changed are rendered again.
+    """
+    VERSION = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                loaded = json.load(f)
+            if loaded.get('version') == TemplateCache.VERSION:
+                self.entries = loaded.get('files', {})
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def default_path() -> str:
+        return os.path.join(get_cache_folder(), 'generated', 'inputs.json')
+
+    @staticmethod
+    def get_inputs(template: str, variables: typing.Dict[str, str]) -> typing.List:
+        st = os.stat(template)
+        return [template, st.st_size, st.st_mtime_ns, json.dumps(variables, sort_keys=True)]
+
+    def render(self, file: PlanEntry, verbose: bool, builtins: typing.Dict[str, str]) -> bool:
+        """render the file if its inputs changed, returns true if it was rendered"""
+        template, declared = file.template
+        variables = dict(builtins, **declared)
+        inputs = TemplateCache.get_inputs(template, variables)
+        if self.entries.get(file.src) == inputs and os.path.isfile(file.src):
+            return False
+        if verbose:
+            print('Rendering', template, 'to', file.src)
+        with open(template, 'r', encoding='utf-8', newline='') as f:
+            text = render_template(f.read(), variables)
+        os.makedirs(os.path.dirname(file.src), exist_ok=True)
+        temp = file.src + '.tmp'
+        with open(temp, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+        import shutil
+        shutil.copymode(template, temp)
+        os.replace(temp, file.src)
+        self.entries[file.src] = inputs
+        self.dirty = True
+        return True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump({'version': TemplateCache.VERSION, 'files': self.entries}, f)
+        os.replace(temp, self.path)
+        self.dirty = False
+
+
+def render_templates(files: typing.Iterable[PlanEntry], verbose: bool = False) -> int:
+    """bring the generated files up to date, returns the number of files rendered"""
+    templates = [f for f in files if f.template is not None and f.active]
+    if len(templates) == 0:
+        return 0
+    cache = TemplateCache(TemplateCache.default_path())
+    builtins = get_builtin_template_variables()
+    rendered = 0
+    for file in templates:
+        with PROFILER.phase('render', file.src):
+            try:
+                if cache.render(file, verbose, builtins):
+                    rendered += 1
+            except KeyError as e:
+                print('Unknown variable {} in template {}'.format(e, file.template[0]))
+            except OSError as e:
+                print('Unable to render', file.template[0], e)
+    cache.save()
+    return rendered
+
+
+def file_digest(path: str) -> str:
+    import hashlib
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class DigestCache:
+    """
+    Persistent content hashes keyed by path, size, mtime and inode,
+    so a file is read at most once per modification across runs.
+    """
+    VERSION = 1
+    MAX_ENTRIES = 50000
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                loaded = json.load(f)
+            if loaded.get('version') == DigestCache.VERSION:
+                self.entries = loaded.get('files', {})
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def default_path() -> str:
+        return os.path.join(get_cache_folder(), 'digests.json')
+
+    def digest(self, path: str, stat: typing.Optional[os.stat_result] = None, key: typing.Optional[str] = None,
+               function: typing.Callable[[str], str] = None) -> str:
+        """the digest of path, computed by function (file_digest) and stored under key (path)"""
+        if stat is None:
+            stat = os.stat(path)
+        if key is None:
+            key = path
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns and entry[2] == stat.st_ino:
+            self.hits += 1
+            return entry[3]
+        self.misses += 1
+        digest = function(path) if function is not None else file_digest(path)
+        with self.lock:
+            self.entries[key] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, digest]
+            self.dirty = True
+        return digest
+
+    def prune(self, keep: typing.AbstractSet[str]):
+        with self.lock:
+            stale = [p for p in self.entries if p not in keep]
+            # dicts keep insertion order, so the oldest entries are evicted first when over the limit
+            overflow = len(self.entries) - len(stale) - DigestCache.MAX_ENTRIES
+            if overflow > 0:
+                stale.extend([p for p in self.entries if p in keep][:overflow])
+            for p in stale:
+                del self.entries[p]
+            if len(stale) > 0:
+                self.dirty = True
+
+    def hit_rate(self) -> str:
+        total = self.hits + self.misses
+        percent = 100.0 * self.hits / total if total > 0 else 100.0
+        return '{} hits, {} misses ({:.1f}% hit rate), {} cached'.format(self.hits, self.misses, percent,
+                                                                       len(self.entries))
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f, self.lock:
+            json.dump({'version': DigestCache.VERSION, 'files': self.entries}, f)
+        os.replace(temp, self.path)
+        self.dirty = False
+
+
+class Manifest:
+    """
+    Remembers the stat signatures of every file pair at the time it was installed (or found identical)
+    so a later run can tell that neither side moved without reading any content.
+    """
+    VERSION = 1
+
+    def __init__(self, path: str, digests: typing.Optional[DigestCache] = None):
+        self.path = path
+        self.digests = digests
+        # digests of parsed files, only loaded when a file is compared by content
+        self.canonical = None
+        self.entries = {}
+        # installed folder to the change key of the submodule it was streamed from, see install_submodules()
+        self.submodules = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                loaded = json.load(f)
+            if loaded.get('version') == Manifest.VERSION:
+                self.entries = loaded.get('files', {})
+                self.submodules = loaded.get('submodules', {})
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def default_path() -> str:
+        return os.path.join(get_cache_folder(), 'install-manifest.json')
+
+    @staticmethod
+    def open_default() -> 'Manifest':
+        return Manifest(Manifest.default_path(), DigestCache(DigestCache.default_path()))
 
+    def digest(self, path: str, stat: typing.Optional[os.stat_result] = None) -> str:
+        if self.digests is None:
+            return file_digest(path)
+        return self.digests.digest(path, stat)
 
-def file_same(lhs: str, rhs: str) -> bool:
-    if file_exist(lhs) and file_exist(rhs):
-        return filecmp.cmp(lhs, rhs)
+    @staticmethod
+    def get_canonical_key(path: str, compare: typing.List) -> str:
+        return path + '\n' + json.dumps(compare)
+
+    def canonical_digest(self, path: str, compare: typing.List) -> str:
+        def function(p: str) -> str:
+            return get_canonical_digest(p, compare)
+        if self.digests is None:
+            return function(path)
+        if self.canonical is None:
+            with self.lock:
+                if self.canonical is None:
+                    self.canonical = DigestCache(os.path.join(get_cache_folder(), 'canonical-digests.json'))
+        return self.canonical.digest(path, None, Manifest.get_canonical_key(path, compare), function)
+
+    def prune(self, plan: 'Plan', *others: 'Plan'):
+        if self.digests is not None:
+            self.digests.prune(frozenset(p for pl in (plan,) + others for e in pl.entries for p in (e.src, e.home)))
+        if self.canonical is not None:
+            self.canonical.prune(frozenset(Manifest.get_canonical_key(p, e.compare) for pl in (plan,) + others
+                                           for e in pl.entries if e.compare is not None for p in (e.src, e.home)))
+
+    def is_unchanged(self, src: str, dst: str, src_stat: typing.Optional[os.stat_result] = None,
+                     dst_stat: typing.Optional[os.stat_result] = None) -> bool:
+        """the stats are looked up when not given, dst_stat is an lstat"""
+        entry = self.entries.get(dst)
+        if entry is None or entry['src'] != src:
+            return False
+        try:
+            if src_stat is None:
+                src_stat = os.stat(src)
+            if dst_stat is None:
+                dst_stat = os.lstat(dst)
+        except OSError:
+            return False
+        # a link install left in HOME would have edits there change the source
+        if stat.S_ISLNK(dst_stat.st_mode):
+            return False
+        if dst_stat.st_ino != entry['dst_ino'] or dst_stat.st_size != entry['dst_size'] \
+                or dst_stat.st_mtime_ns != entry['dst_mtime']:
+            return False
+        if src_stat.st_size != entry['src_size']:
+            return False
+        if src_stat.st_mtime_ns == entry['src_mtime']:
+            return True
+        # source was touched (checkout, rebase...) but may still hold the installed content
+        if self.digest(src, src_stat) != entry['digest']:
+            return False
+        entry['src_mtime'] = src_stat.st_mtime_ns
+        self.dirty = True
+        return True
+
+    def record(self, src: str, dst: str, src_stat: typing.Optional[os.stat_result] = None,
+               dst_stat: typing.Optional[os.stat_result] = None):
+        try:
+            if src_stat is None:
+                src_stat = os.stat(src)
+            if dst_stat is None:
+                dst_stat = os.lstat(dst)
+            digest = self.digest(src, src_stat)
+        except OSError:
+            self.forget(dst)
+            return
+        with self.lock:
+            self.entries[dst] = {
+                'src': src,
+                'src_size': src_stat.st_size,
+                'src_mtime': src_stat.st_mtime_ns,
+                'digest': digest,
+                'dst_ino': dst_stat.st_ino,
+                'dst_size': dst_stat.st_size,
+                'dst_mtime': dst_stat.st_mtime_ns,
+            }
+            self.dirty = True
+
+    def record_extracted(self, src: str, dst: str, digest: str, size: typing.Optional[int] = None):
+        """
+        record a file extracted from a bundle or archive, src may differ and is checked by digest when compared.
+        size is the size of src, the size of dst when not given
+        """
+        try:
+            dst_stat = os.lstat(dst)
+        except OSError:
+            self.forget(dst)
+            return
+        with self.lock:
+            self.entries[dst] = {
+                'src': src,
+                'src_size': size if size is not None else dst_stat.st_size,
+                # never matches, so the first is_unchanged() compares the digest
+                'src_mtime': -1,
+                'digest': digest,
+                'dst_ino': dst_stat.st_ino,
+                'dst_size': dst_stat.st_size,
+                'dst_mtime': dst_stat.st_mtime_ns,
+            }
+            self.dirty = True
+
+    def forget(self, path: str):
+        with self.lock:
+            if self.entries.pop(path, None) is not None:
+                self.dirty = True
+            # a file removed from an installed submodule means it has to be installed again
+            for folder in [f for f in self.submodules if path.startswith(f + os.sep)]:
+                del self.submodules[folder]
+                self.dirty = True
+
+    def has_installed(self, dst: str, digest: str) -> bool:
+        """true if dst was installed with the digest and hasn't been touched since"""
+        entry = self.entries.get(dst)
+        return entry is not None and entry['digest'] == digest and self.is_untouched(dst)
+
+    def is_untouched(self, dst: str) -> bool:
+        """true if dst is still the file that was recorded, only an lstat and no reads"""
+        entry = self.entries.get(dst)
+        if entry is None:
+            return False
+        try:
+            dst_stat = os.lstat(dst)
+        except OSError:
+            return False
+        return dst_stat.st_ino == entry['dst_ino'] and dst_stat.st_size == entry['dst_size'] \
+            and dst_stat.st_mtime_ns == entry['dst_mtime']
+
+    def set_submodule(self, folder: str, key: typing.Optional[str]):
+        with self.lock:
+            if self.submodules.get(folder) != key:
+                if key is None:
+                    del self.submodules[folder]
+                else:
+                    self.submodules[folder] = key
+                self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            if self.digests is not None:
+                self.digests.save()
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f, self.lock:
+            json.dump({'version': Manifest.VERSION, 'files': self.entries, 'submodules': self.submodules}, f)
+        os.replace(temp, self.path)
+        self.dirty = False
+        if self.digests is not None:
+            self.digests.save()
+        if self.canonical is not None:
+            self.canonical.save()
+
+
+def skip_json_string(text: str, start: int) -> int:
+    """index after the string literal that starts at start"""
+    i = start + 1
+    while i < len(text) and text[i] != '"':
+        i += 2 if text[i] == '\\' else 1
+    return i + 1
+
+
+def strip_json_comments(text: str) -> str:
+    """json with comments and trailing commas, as written by vscode and windows terminal, to plain json"""
+    out = []
+    i = 0
+    while i < len(text):
+        if text[i] == '"':
+            end = skip_json_string(text, i)
+            out.append(text[i:end])
+            i = end
+        elif text.startswith('//', i):
+            end = text.find('\n', i)
+            i = len(text) if end == -1 else end
+        elif text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = len(text) if end == -1 else end + 2
+        else:
+            out.append(text[i])
+            i += 1
+    text = ''.join(out)
+
+    out = []
+    i = 0
+    while i < len(text):
+        if text[i] == '"':
+            end = skip_json_string(text, i)
+            out.append(text[i:end])
+            i = end
+            continue
+        if text[i] == ',':
+            following = i + 1
+            while following < len(text) and text[following] in ' \t\r\n':
+                following += 1
+            if text[following:following + 1] in ('}', ']'):
+                i += 1
+                continue
+        out.append(text[i])
+        i += 1
+    return ''.join(out)
+
+
+def remove_json_keys(value, path: typing.List[str]):
+    if len(path) == 0:
+        return
+    name, rest = path[0], path[1:]
+    if isinstance(value, dict):
+        keys = list(value.keys()) if name == '*' else [name] if name in value else []
+        for key in keys:
+            if len(rest) == 0:
+                del value[key]
+            else:
+                remove_json_keys(value[key], rest)
+    elif isinstance(value, list):
+        if name == '*':
+            if len(rest) == 0:
+                value.clear()
+            for item in value:
+                remove_json_keys(item, rest)
+        elif name.isdigit() and int(name) < len(value):
+            if len(rest) == 0:
+                del value[int(name)]
+            else:
+                remove_json_keys(value[int(name)], rest)
+
+
+def get_canonical_json(path: str, ignore: typing.List[str]) -> str:
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        value = json.loads(strip_json_comments(f.read()))
+    for key_path in ignore:
+        remove_json_keys(value, key_path.split('/'))
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+COMPARE_FUNCTIONS = {
+    'json': get_canonical_json,
+}
+
+
+def get_canonical_digest(path: str, compare: typing.List) -> str:
+    import hashlib
+    kind, ignore = compare
+    return hashlib.sha256(COMPARE_FUNCTIONS[kind](path, ignore).encode('utf-8')).hexdigest()
+
+
+def structured_same(lhs: str, rhs: str, compare: typing.List, manifest: Manifest) -> bool:
+    """true if both files parse to the same content, files that don't parse are only the same byte for byte"""
+    try:
+        with PROFILER.phase('parse', lhs):
+            return manifest.canonical_digest(lhs, compare) == manifest.canonical_digest(rhs, compare)
+    except (OSError, ValueError) as e:
+        print('Unable to compare {} and {} by content: {}'.format(lhs, rhs, e))
+        return False
+
+
+def file_same(lhs: str, rhs: str, digests: typing.Optional[DigestCache] = None,
+              lhs_stat: typing.Optional[os.stat_result] = None, rhs_stat: typing.Optional[os.stat_result] = None) -> bool:
+    """the stats are looked up when not given"""
+    if lhs_stat is None:
+        lhs_stat = stat_or_none(lhs)
+    if rhs_stat is None:
+        rhs_stat = stat_or_none(rhs)
+    if is_regular(lhs_stat) and is_regular(rhs_stat):
+        if digests is None:
+            import filecmp
+            return filecmp.cmp(lhs, rhs)
+        if lhs_stat.st_size != rhs_stat.st_size:
+            return False
+        if lhs_stat.st_ino == rhs_stat.st_ino and lhs_stat.st_dev == rhs_stat.st_dev:
+            return True
+        return digests.digest(lhs, lhs_stat) == digests.digest(rhs, rhs_stat)
     else:
         return False
 
 
-def remove_file(file_to_remove: str, verbose: bool, dry_run: bool):
+def stat_or_none(path: str) -> typing.Optional[os.stat_result]:
+    try:
+        return os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def is_regular(st: typing.Optional[os.stat_result]) -> bool:
+    return st is not None and stat.S_ISREG(st.st_mode)
+
+
+class DirectoryHandles:
+    """
+    Folders opened once and kept open by path, so the files in a folder are stat'ed, written, renamed and removed
+    relative to the handle instead of resolving every part of the full path for each call, which adds up on deep
+    trees and network homes. Each thread has its own handles. Without dir_fd support (Windows) the full paths are used.
+    """
+    MAX_OPEN = 64
+
+    def __init__(self, use_handles: bool = True):
+        # os.replace() is os.rename() that overwrites, only rename is listed
+        self.use_handles = use_handles and hasattr(os, 'O_DIRECTORY') and \
+            all(f in os.supports_dir_fd for f in (os.stat, os.unlink, os.rmdir, os.readlink, os.open, os.rename,
+                                                  os.link, os.symlink))
+        self.local = threading.local()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def get_handles(self) -> typing.Dict[str, int]:
+        handles = getattr(self.local, 'handles', None)
+        if handles is None:
+            handles = self.local.handles = {}
+            with self.lock:
+                self.opened.append(handles)
+        return handles
+
+    def open_folder(self, folder: str) -> typing.Optional[int]:
+        """the handle of folder, None if it can't be opened"""
+        if not self.use_handles:
+            return None
+        handles = self.get_handles()
+        # most recently used last
+        fd = handles.pop(folder, None)
+        if fd is None:
+            try:
+                fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY | getattr(os, 'O_CLOEXEC', 0))
+            except OSError:
+                return None
+            if len(handles) >= DirectoryHandles.MAX_OPEN:
+                os.close(handles.pop(next(iter(handles))))
+        handles[folder] = fd
+        return fd
+
+    def locate(self, path: str) -> typing.Tuple[typing.Optional[int], str]:
+        """the handle of the folder of path and the name in it, or no handle and the full path"""
+        folder, name = os.path.split(path)
+        fd = self.open_folder(folder)
+        return (None, path) if fd is None else (fd, name)
+
+    def close_folder(self, folder: str):
+        fd = self.get_handles().pop(folder, None)
+        if fd is not None:
+            os.close(fd)
+
+    def stat(self, path: str, follow_symlinks: bool = True) -> typing.Optional[os.stat_result]:
+        """None if path doesn't exist"""
+        folder, name = os.path.split(path)
+        fd = self.open_folder(folder)
+        try:
+            if fd is None:
+                return os.stat(path, follow_symlinks=follow_symlinks)
+            return os.stat(name, dir_fd=fd, follow_symlinks=follow_symlinks)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def lstat(self, path: str) -> typing.Optional[os.stat_result]:
+        return self.stat(path, False)
+
+    def readlink(self, path: str) -> str:
+        folder, name = os.path.split(path)
+        fd = self.open_folder(folder)
+        return os.readlink(path) if fd is None else os.readlink(name, dir_fd=fd)
+
+    def unlink(self, path: str):
+        folder, name = os.path.split(path)
+        fd = self.open_folder(folder)
+        if fd is None:
+            os.remove(path)
+        else:
+            os.unlink(name, dir_fd=fd)
+
+    def remove_existing(self, path: str):
+        try:
+            self.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def open_write(self, path: str) -> typing.BinaryIO:
+        fd, name = self.locate(path)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0) | getattr(os, 'O_CLOEXEC', 0)
+        return os.fdopen(os.open(name, flags, 0o666, dir_fd=fd), 'wb')
+
+    def copy_file(self, src: str, dst: str):
+        """like shutil.copy(), the content and the permission bits"""
+        import shutil
+        if not self.use_handles:
+            shutil.copy(src, dst)
+            return
+        with open(src, 'rb') as source, self.open_write(dst) as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+            chmod_open_file(destination, dst, stat.S_IMODE(os.fstat(source.fileno()).st_mode))
+
+    def symlink(self, src: str, dst: str):
+        fd, name = self.locate(dst)
+        os.symlink(src, name, dir_fd=fd)
+
+    def link(self, src: str, dst: str):
+        """hardlink src itself, not what it points to"""
+        src_fd, src_name = self.locate(src)
+        dst_fd, dst_name = self.locate(dst)
+        os.link(src_name, dst_name, src_dir_fd=src_fd, dst_dir_fd=dst_fd, follow_symlinks=False)
+
+    def replace(self, src: str, dst: str):
+        src_fd, src_name = self.locate(src)
+        dst_fd, dst_name = self.locate(dst)
+        os.replace(src_name, dst_name, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+
+    def sync_folder(self, folder: str) -> bool:
+        """fsync the open handle of folder, false if there is none"""
+        fd = self.open_folder(folder)
+        if fd is None:
+            return False
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        return True
+
+    def makedirs(self, folder: str) -> bool:
+        """make sure folder exists, returns true if it had to be created"""
+        if self.open_folder(folder) is not None or os.path.isdir(folder):
+            return False
+        os.makedirs(folder, exist_ok=True)
+        return True
+
+    def remove_empty_folders(self, folders: typing.Iterable[str], stop: str) -> typing.List[str]:
+        """remove the folders, and then their parents, while they are empty. Nothing outside of stop is removed."""
+        stop = os.path.abspath(stop)
+        removed = []
+        # deepest first so a parent is only tried once its children are gone
+        for folder in sorted(set(folders), key=len, reverse=True):
+            while folder.startswith(stop + os.sep) and folder not in removed:
+                parent, name = os.path.split(folder)
+                self.close_folder(folder)
+                fd = self.open_folder(parent)
+                try:
+                    if fd is None:
+                        os.rmdir(folder)
+                    else:
+                        os.rmdir(name, dir_fd=fd)
+                except OSError:
+                    # not empty
+                    break
+                removed.append(folder)
+                folder = parent
+        return removed
+
+    def close(self):
+        with self.lock:
+            for handles in self.opened:
+                for fd in handles.values():
+                    os.close(fd)
+                handles.clear()
+
+
+# used when no handles are given, works on the full paths
+PATH_HANDLES = DirectoryHandles(False)
+
+
+def chmod_open_file(f: typing.BinaryIO, path: str, mode: int):
+    # through the open file when possible, the path is already resolved
+    if os.chmod in os.supports_fd:
+        os.chmod(f.fileno(), mode)
+    else:
+        os.chmod(path, mode)
+
+
+def remove_file(file_to_remove: str, verbose: bool, dry_run: bool, handles: DirectoryHandles = PATH_HANDLES):
     if verbose:
         print('Removing file', file_to_remove)
     if dry_run:
         if not verbose:
             print('Removing file', file_to_remove)
     else:
-        os.remove(file_to_remove)
+        with PROFILER.phase('remove', file_to_remove):
+            handles.unlink(file_to_remove)
 
 
 def error_detected(ignore_errors: bool):
@@ -222,30 +1492,57 @@ def error_detected(ignore_errors: bool):
         sys.exit(-42)
 
 
-def clean_single_file(use_home: bool, verbose: bool, dry: bool, file: Path):
-    p = file.home.get_abs_path() if use_home else os.path.join(get_src_folder(), file.src)
-    if file_exist(p):
+def clean_single_file(use_home: bool, verbose: bool, dry: bool, file: PlanEntry,
+                      manifest: typing.Optional[Manifest] = None, snapshot: typing.Optional['Snapshot'] = None,
+                      handles: DirectoryHandles = PATH_HANDLES) -> bool:
+    """returns true if the file was, or would be, removed"""
+    p = file.home if use_home else file.src
+    st = handles.lstat(p)
+    # a symlink install is removed as a link, even when its target is gone
+    if st is not None and stat.S_ISLNK(st.st_mode) and not use_home:
+        st = handles.stat(p)
+    if is_regular(st) or (st is not None and stat.S_ISLNK(st.st_mode)):
         if verbose:
             print("File exists ", p)
-        remove_file(p, verbose, dry)
+        if snapshot is not None and use_home and not dry:
+            snapshot.add(p, True)
+        remove_file(p, verbose, dry, handles)
+        if manifest is not None and not dry:
+            manifest.forget(p)
+        return True
     else:
         if verbose:
             print("File doesn't exists ", p)
+        return False
 
 
-def clean_interesting(use_home: bool, verbose: bool, dry: bool, data: Data):
-    for file in data.interesting_files:
-        clean_single_file(use_home, verbose, dry, file)
+def clean_interesting(use_home: bool, verbose: bool, dry: bool, plan: Plan,
+                      manifest: typing.Optional[Manifest] = None, snapshot: typing.Optional['Snapshot'] = None,
+                      handles: DirectoryHandles = PATH_HANDLES) -> typing.List[str]:
+    """returns the removed files"""
+    return [file.home if use_home else file.src for file in plan.entries
+            if clean_single_file(use_home, verbose, dry, file, manifest, snapshot, handles)]
 
 
 def add_verbose(sub):
     sub.add_argument('--verbose', '-v', dest='verbose', action='store_true', help='Verbose output')
 
 
+def add_jobs(sub, default: int = 1):
+    sub.add_argument('--jobs', '-j', dest='jobs', type=int, default=default,
+                     help='Number of files to compare and copy concurrently')
+
+
 def add_dry(sub):
     sub.add_argument('--dry-run', '--dry', '-0', dest='dry', action='store_true', help="Don't copy or remove anything")
 
 
+def add_mode(sub):
+    sub.add_argument('--mode', '-m', dest='mode', choices=list(INSTALL_MODES.keys()), default='copy',
+                     help='How files are placed in HOME, reflink falls back to copy when not supported. '
+                          'Use --force to turn existing hardlinks into copies')
+
+
 def add_copy_commands(sub):
     sub.add_argument('search', nargs='*')
     add_verbose(sub)
@@ -254,22 +1551,527 @@ def add_copy_commands(sub):
     sub.add_argument('--force', '-f', dest='force', action='store_true', help='Force copy even if the file exist')
     sub.add_argument('--ignore-errors', '--continue-on-error', '-ie', '-ce', dest='ignore_errors', action='store_true',
                      help="Don't stop on errors")
+    add_jobs(sub)
+    sub.add_argument('--direct', action='store_true',
+                     help='Write each file in place instead of staging the batch and renaming it into place')
+
+
+def is_link_to(src: str, dst: str) -> bool:
+    """true if src is a symlink that resolves to dst"""
+    return os.path.islink(src) and os.path.exists(dst) and os.path.samefile(src, dst)
+
+
+def remove_link(src: str, dst: str):
+    # never write through a symlink or a hardlink of the source, that would modify the source
+    # but when src is a symlink to dst, dst is the source and removing it would lose the file
+    if os.path.islink(dst):
+        os.remove(dst)
+    elif not os.path.islink(src) and os.path.exists(dst) and os.path.samefile(src, dst):
+        os.remove(dst)
+
+
+def remove_existing(dst: str):
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+
+def install_copy(src: str, dst: str, handles: DirectoryHandles = PATH_HANDLES):
+    if is_link_to(src, dst):
+        # grabbing a symlink install, dst already has the content
+        return
+    remove_link(src, dst)
+    handles.copy_file(src, dst)
+
+
+def install_symlink(src: str, dst: str, handles: DirectoryHandles = PATH_HANDLES):
+    handles.remove_existing(dst)
+    handles.symlink(src, dst)
+
+
+def install_hardlink(src: str, dst: str, handles: DirectoryHandles = PATH_HANDLES):
+    handles.remove_existing(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        print('Unable to hardlink, copying instead:', e)
+        handles.copy_file(src, dst)
+
+
+FICLONE = 0x40049409
+
+
+def install_reflink(src: str, dst: str, handles: DirectoryHandles = PATH_HANDLES):
+    if is_link_to(src, dst):
+        return
+    remove_link(src, dst)
+    try:
+        import fcntl
+        with open(src, 'rb') as source, handles.open_write(dst) as destination:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+            chmod_open_file(destination, dst, stat.S_IMODE(os.fstat(source.fileno()).st_mode))
+    except (ImportError, OSError):
+        handles.copy_file(src, dst)
+
+
+INSTALL_MODES = {
+    'copy': install_copy,
+    'symlink': install_symlink,
+    'hardlink': install_hardlink,
+    'reflink': install_reflink,
+}
+
+
+def installed_same(src: str, dst: str, mode: str, digests: typing.Optional[DigestCache],
+                   src_stat: typing.Optional[os.stat_result] = None, dst_stat: typing.Optional[os.stat_result] = None,
+                   handles: DirectoryHandles = PATH_HANDLES) -> bool:
+    """the stats are looked up when not given, dst_stat is an lstat"""
+    if dst_stat is None:
+        dst_stat = handles.lstat(dst)
+    if dst_stat is not None and stat.S_ISLNK(dst_stat.st_mode):
+        return mode == 'symlink' and handles.readlink(dst) == src
+    if mode == 'symlink':
+        return False
+    if src_stat is None:
+        src_stat = handles.stat(src)
+    if mode == 'hardlink':
+        return src_stat is not None and dst_stat is not None and os.path.samestat(src_stat, dst_stat)
+    return file_same(src, dst, digests, src_stat, dst_stat)
+
+
+class Transaction:
+    """
+    Stages every changed file under a temporary name next to its destination, syncs the whole batch once
+    and then renames everything into place. The previous files are kept as hardlinked, or copied, backups and a
+    journal is written before the renames so a failure, or a crash, can restore the previous state.
+    Every destination is logged before it is staged so a crash before the journal leaves no temporary files.
+    The files are written, backed up and renamed relative to the handles of their folders, one folder at a time.
+    """
+    NEW_SUFFIX = '.dotlib-new'
+    OLD_SUFFIX = '.dotlib-old'
+    STAGED_SUFFIX = '.staged'
+
+    def __init__(self, journal_path: str, manifest: typing.Optional[Manifest] = None,
+                 handles: DirectoryHandles = PATH_HANDLES):
+        self.journal_path = journal_path
+        self.staged_path = journal_path + Transaction.STAGED_SUFFIX
+        self.manifest = manifest
+        self.handles = handles
+        self.staged = []
+        self.staged_log = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def default_journal_path(root: typing.Optional[str] = None) -> str:
+        if root is None:
+            return os.path.join(get_cache_folder(), 'install-journal.json')
+        # one journal per root so installs into several roots can run, and fail, independently
+        import hashlib
+        name = hashlib.sha1(os.path.abspath(root).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(get_cache_folder(), 'install-journal-{}.json'.format(name))
+
+    def stage(self, src: str, dst: str, file_function, record: bool = True, digest: typing.Optional[str] = None):
+        """
+        record is false for link installs, those are checked without the manifest. digest is given for files
+        extracted from an archive, that may differ from the file at src
+        """
+        with self.lock:
+            if self.staged_log is None:
+                os.makedirs(os.path.dirname(self.staged_path), exist_ok=True)
+                self.staged_log = open(self.staged_path, 'w', encoding='utf-8')
+            # only flushed, a crash of the process is what leaves temporary files behind
+            self.staged_log.write(dst + '\n')
+            self.staged_log.flush()
+        temp = dst + Transaction.NEW_SUFFIX
+        self.handles.remove_existing(temp)
+        try:
+            file_function(src, temp, self.handles)
+        except BaseException:
+            self.handles.remove_existing(temp)
+            raise
+        with self.lock:
+            self.staged.append((src, dst, record, digest))
+
+    def abort(self):
+        for _, dst, _, _ in self.staged:
+            self.handles.remove_existing(dst + Transaction.NEW_SUFFIX)
+        self.staged = []
+        self.remove_staged_log()
+
+    def remove_staged_log(self):
+        if self.staged_log is not None:
+            self.staged_log.close()
+            self.staged_log = None
+        remove_existing(self.staged_path)
+
+    def write_journal(self, entries: typing.List[typing.Tuple[str, bool]]):
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        with open(self.journal_path, 'w', encoding='utf-8') as f:
+            json.dump([[dst, had_original] for dst, had_original in entries], f)
+            f.flush()
+            os.fsync(f.fileno())
+        sync_folders([os.path.dirname(self.journal_path)])
+
+    def commit(self):
+        if len(self.staged) == 0:
+            self.remove_staged_log()
+            return
+        handles = self.handles
+        # staged in plan order, sorted by folder so each step below goes through one folder handle at a time
+        self.staged.sort(key=lambda s: os.path.dirname(s[1]))
+        sync_files([dst + Transaction.NEW_SUFFIX for _, dst, _, _ in self.staged], handles)
+
+        entries = []
+        try:
+            for _, dst, _, _ in self.staged:
+                backup = dst + Transaction.OLD_SUFFIX
+                handles.remove_existing(backup)
+                had_original = handles.lstat(dst) is not None
+                if had_original:
+                    Transaction.backup(dst, backup, handles)
+                entries.append((dst, had_original))
+            self.write_journal(entries)
+            for _, dst, _, _ in self.staged:
+                handles.replace(dst + Transaction.NEW_SUFFIX, dst)
+            # the renames are only durable once the folders holding them are synced
+            sync_folders(sorted(set(os.path.dirname(dst) for _, dst, _, _ in self.staged)), handles)
+        except BaseException:
+            print('Install failed, restoring previous files')
+            Transaction.restore(entries)
+            self.abort()
+            remove_existing(self.journal_path)
+            raise
+
+        for dst, _ in entries:
+            handles.remove_existing(dst + Transaction.OLD_SUFFIX)
+        remove_existing(self.journal_path)
+        self.remove_staged_log()
+        if self.manifest is not None:
+            for src, dst, record, digest in self.staged:
+                if not record:
+                    continue
+                if digest is None:
+                    self.manifest.record(src, dst)
+                else:
+                    self.manifest.record_extracted(src, dst, digest)
+        self.staged = []
+
+    @staticmethod
+    def backup(dst: str, backup: str, handles: DirectoryHandles = PATH_HANDLES):
+        try:
+            handles.link(dst, backup)
+        except OSError:
+            # vfat, most CIFS mounts and some FUSE filesystems have no hardlinks
+            import shutil
+            shutil.copy2(dst, backup, follow_symlinks=False)
+
+    @staticmethod
+    def restore(entries: typing.Iterable[typing.Tuple[str, bool]]):
+        for dst, had_original in entries:
+            backup = dst + Transaction.OLD_SUFFIX
+            if had_original:
+                if os.path.lexists(backup):
+                    os.replace(backup, dst)
+                # renaming onto another link of the same file is a no-op that leaves the backup behind
+                remove_existing(backup)
+            else:
+                remove_existing(dst)
+            remove_existing(dst + Transaction.NEW_SUFFIX)
+
+    def recover(self):
+        """Finish or undo a transaction that was interrupted by a crash"""
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                entries = [(dst, had_original) for dst, had_original in json.load(f)]
+        except (OSError, ValueError):
+            entries = None
+        if entries is not None:
+            if any(os.path.lexists(dst + Transaction.NEW_SUFFIX) for dst, _ in entries):
+                print('Previous install was interrupted, restoring {} files'.format(len(entries)))
+                Transaction.restore(entries)
+            else:
+                # every rename went through, only the cleanup was missed
+                for dst, _ in entries:
+                    remove_existing(dst + Transaction.OLD_SUFFIX)
+            remove_existing(self.journal_path)
+
+        # the install stopped before the journal was written, nothing was renamed so the staged files are dropped
+        try:
+            with open(self.staged_path, 'r', encoding='utf-8') as f:
+                staged = f.read().splitlines()
+        except OSError:
+            return
+        for dst in staged:
+            remove_existing(dst + Transaction.NEW_SUFFIX)
+            remove_existing(dst + Transaction.OLD_SUFFIX)
+        remove_existing(self.staged_path)
+
+
+def sync_files(paths: typing.List[str], handles: DirectoryHandles = PATH_HANDLES):
+    """fsync each file, unlike os.sync() this leaves every other filesystem, like a slow NAS, alone"""
+    for p in paths:
+        st = handles.lstat(p)
+        if st is None or stat.S_ISLNK(st.st_mode):
+            continue
+        folder_fd, name = handles.locate(p)
+        fd = os.open(name, os.O_RDONLY, dir_fd=folder_fd)
+        try:
+            os.fsync(fd)
+        except OSError:
+            # windows can't fsync a file opened for reading
+            pass
+        finally:
+            os.close(fd)
+
+
+def sync_folders(folders: typing.Iterable[str], handles: DirectoryHandles = PATH_HANDLES):
+    """fsync folders so the files created and renamed in them are durable, not possible on windows"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    for folder in folders:
+        if handles.sync_folder(folder):
+            continue
+        try:
+            fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError:
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+class SnapshotStore:
+    """
+    Content addressed store of files from HOME, taken before dotlib overwrites or removes them.
+    Objects are named by their sha256 so every version is stored once, no matter how many snapshots refer to it.
+    """
+    MAX_SNAPSHOTS = 50
+    # old snapshots are dropped, and unused objects collected, in batches instead of on every save
+    GC_BATCH = 10
+
+    def __init__(self, path: str):
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        self.snapshots = os.path.join(path, 'snapshots')
+
+    @staticmethod
+    def default_path() -> str:
+        return os.path.join(get_cache_folder(), 'snapshots')
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def snapshot_path(self, name: str) -> str:
+        return os.path.join(self.snapshots, name + '.json')
+
+    def list(self) -> typing.List[str]:
+        try:
+            return sorted(f[:-len('.json')] for f in os.listdir(self.snapshots) if f.endswith('.json'))
+        except OSError:
+            return []
+
+    def find(self, name: typing.Optional[str]) -> typing.Optional[str]:
+        """the latest snapshot, or the one starting with name"""
+        names = self.list()
+        if name is not None:
+            names = [n for n in names if n.startswith(name)]
+        return names[-1] if len(names) > 0 else None
+
+    def load(self, name: str) -> typing.Dict[str, typing.Optional[dict]]:
+        with open(self.snapshot_path(name), 'r', encoding='utf-8') as f:
+            return json.load(f)['files']
+
+    def store(self, path: str, digest: str, allow_link: bool) -> bool:
+        """returns true if the object is a new hardlink of path"""
+        target = self.object_path(digest)
+        if os.path.exists(target):
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if allow_link:
+            try:
+                os.link(path, target)
+                return True
+            except FileExistsError:
+                return False
+            except OSError:
+                # another filesystem or no hardlinks, fall back to a copy
+                pass
+        self.copy_object(path, target)
+        return False
+
+    @staticmethod
+    def copy_object(path: str, target: str):
+        import shutil
+        temp = '{}.{}.tmp'.format(target, threading.get_ident())
+        shutil.copyfile(path, temp)
+        os.replace(temp, target)
+
+    def unlink_object(self, digest: str):
+        """give a linked object an inode of its own"""
+        target = self.object_path(digest)
+        SnapshotStore.copy_object(target, target)
+
+    def new_name(self) -> str:
+        base = time.strftime('%Y%m%d-%H%M%S')
+        name = base
+        index = 1
+        while os.path.exists(self.snapshot_path(name)):
+            index += 1
+            name = '{}-{}'.format(base, index)
+        return name
+
+    def save(self, files: typing.Dict[str, typing.Optional[dict]]) -> str:
+        os.makedirs(self.snapshots, exist_ok=True)
+        name = self.new_name()
+        temp = self.snapshot_path(name) + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump({'created': time.time(), 'files': files}, f)
+        os.replace(temp, self.snapshot_path(name))
+        names = self.list()
+        if len(names) > SnapshotStore.MAX_SNAPSHOTS + SnapshotStore.GC_BATCH:
+            self.collect_garbage(names)
+        return name
+
+    def collect_garbage(self, names: typing.List[str]):
+        for name in names[:-SnapshotStore.MAX_SNAPSHOTS]:
+            remove_existing(self.snapshot_path(name))
+        used = set()
+        for name in names[-SnapshotStore.MAX_SNAPSHOTS:]:
+            try:
+                used.update(e['digest'] for e in self.load(name).values() if e is not None and 'digest' in e)
+            except (OSError, ValueError, KeyError):
+                pass
+        try:
+            folders = os.listdir(self.objects)
+        except OSError:
+            return
+        for folder in folders:
+            for digest in os.listdir(os.path.join(self.objects, folder)):
+                if digest not in used:
+                    remove_existing(os.path.join(self.objects, folder, digest))
+
+
+class Snapshot:
+    """The files in HOME a single command is about to change, as they were before the first change"""
+
+    def __init__(self, store: SnapshotStore, manifest: Manifest):
+        self.store = store
+        self.manifest = manifest
+        self.files = {}
+        # dst: digest of the objects that are hardlinks of dst, checked when saving
+        self.linked = {}
+        self.lock = threading.Lock()
+
+    def add(self, dst: str, allow_link: bool):
+        """
+        remember dst before it is changed, only link to dst if it is going to be removed or renamed over and
+        never written to in place. Save after the change so a link to a file that was left alone can be undone
+        """
+        with self.lock:
+            if dst in self.files:
+                return
+            self.files[dst] = None
+        linked = False
+        if os.path.islink(dst):
+            entry = {'link': os.readlink(dst)}
+        elif os.path.isfile(dst):
+            st = os.stat(dst)
+            digest = self.manifest.digest(dst, st)
+            # a hardlink install shares the inode with the source, which could be edited in place
+            allow_link = allow_link and st.st_nlink == 1
+            with PROFILER.phase('snapshot', dst):
+                linked = self.store.store(dst, digest, allow_link)
+            entry = {'digest': digest, 'mode': st.st_mode & 0o7777}
+        else:
+            entry = None
+        with self.lock:
+            self.files[dst] = entry
+            if linked:
+                self.linked[dst] = entry['digest']
+
+    def drop_unchanged(self):
+        """
+        a file that still shares its inode with the stored object was never removed or renamed over, the
+        install failed or was aborted, so it isn't part of the snapshot and must not be edited through the store
+        """
+        for dst, digest in self.linked.items():
+            try:
+                st = os.lstat(dst)
+                same = os.path.samestat(st, os.lstat(self.store.object_path(digest)))
+            except OSError:
+                continue
+            if same:
+                self.store.unlink_object(digest)
+                del self.files[dst]
+        self.linked = {}
+
+    def save(self) -> typing.Optional[str]:
+        self.drop_unchanged()
+        if len(self.files) == 0:
+            return None
+        return self.store.save(self.files)
+
+
+def begin_snapshot(args, manifest: Manifest) -> typing.Optional[Snapshot]:
+    if args.dry:
+        return None
+    return Snapshot(SnapshotStore(SnapshotStore.default_path()), manifest)
+
+
+def end_snapshot(snapshot: typing.Optional[Snapshot], verbose: bool):
+    if snapshot is None:
+        return
+    name = snapshot.save()
+    if name is not None and verbose:
+        print('Saved previous files as snapshot', name)
 
 
 def file_base(src: str, dst: str, remove: bool, force: bool, verbose: bool, ignore_errors: bool, dry: bool,
-              file_function):
-    if not file_exist(src):
+              file_function, manifest: typing.Optional[Manifest] = None, mode: str = 'copy',
+              transaction: typing.Optional[Transaction] = None, snapshot: typing.Optional[Snapshot] = None,
+              compare: typing.Optional[typing.List] = None, handles: DirectoryHandles = PATH_HANDLES) -> bool:
+    """returns true if dst was written, or staged to be written"""
+    # link installs are verified with a readlink or two stats, the manifest is only needed for copies
+    if mode in ('symlink', 'hardlink') and manifest is not None:
+        manifest.forget(dst)
+        manifest = None
+    # both looked up once, relative to the folder handles, and reused for every check below
+    src_stat = handles.stat(src)
+    dst_stat = handles.lstat(dst)
+    if not remove and not force and manifest is not None:
+        with PROFILER.phase('compare', dst):
+            unchanged = src_stat is not None and dst_stat is not None and \
+                manifest.is_unchanged(src, dst, src_stat, dst_stat)
+        if unchanged:
+            if verbose:
+                print('Files are unchanged since last install', src, dst)
+            return
+    if not is_regular(src_stat):
         print('Missing file', src)
         error_detected(ignore_errors)
         return
-    if file_exist(dst):
+    if dst_stat is not None and (stat.S_ISLNK(dst_stat.st_mode) or stat.S_ISREG(dst_stat.st_mode)):
         if remove:
             if dry:
                 print("Removing ", dst)
             else:
-                remove_file(dst, verbose, False)
+                if snapshot is not None:
+                    snapshot.add(dst, True)
+                remove_file(dst, verbose, False, handles)
+                if manifest is not None:
+                    manifest.forget(dst)
         else:
-            if file_same(src, dst):
+            with PROFILER.phase('compare', dst):
+                same = installed_same(src, dst, mode, manifest.digests if manifest is not None else None, src_stat,
+                                      dst_stat, handles)
+                # a copy that only differs in whitespace, comments or key order isn't rewritten
+                if not same and compare is not None and manifest is not None:
+                    same = structured_same(src, dst, compare, manifest)
+            if same:
+                if manifest is not None:
+                    manifest.record(src, dst, src_stat, dst_stat)
                 if verbose:
                     print('Files are the same', src, dst)
                 if not force:
@@ -279,17 +2081,50 @@ def file_base(src: str, dst: str, remove: bool, force: bool, verbose: bool, igno
             else:
                 if verbose:
                     print('Files are not the same', src, dst)
-    print('Copying file', src, "to", dst)
+    print('Copying file' if mode == 'copy' else 'Installing ({}) file'.format(mode), src, "to", dst)
     if not dry:
         subdir = os.path.dirname(os.path.abspath(dst))
-        if not os.path.exists(subdir):
+        if handles.makedirs(subdir):
             print("Needed to create directory:", subdir)
-            os.makedirs(subdir)
-        file_function(src, dst)
+        if snapshot is not None:
+            # a transaction renames the new file over dst so the old inode is left alone
+            snapshot.add(dst, transaction is not None)
+        with PROFILER.phase('copy', dst):
+            if transaction is not None:
+                transaction.stage(src, dst, file_function, manifest is not None)
+                return True
+            file_function(src, dst, handles)
+        if manifest is not None:
+            manifest.record(src, dst, src_stat, handles.lstat(dst))
+        return True
+    return False
+
+
+def file_copy(src: str, dst: str, remove: bool, force: bool, verbose: bool, ignore_errors: bool, dry: bool,
+              manifest: typing.Optional[Manifest] = None, mode: str = 'copy',
+              transaction: typing.Optional[Transaction] = None, snapshot: typing.Optional[Snapshot] = None,
+              compare: typing.Optional[typing.List] = None, handles: DirectoryHandles = PATH_HANDLES) -> bool:
+    return file_base(src, dst, remove, force, verbose, ignore_errors, dry, INSTALL_MODES[mode], manifest, mode,
+                     transaction, snapshot, compare, handles)
+
 
+def begin_transaction(args, manifest: Manifest, root: typing.Optional[str] = None,
+                      handles: DirectoryHandles = PATH_HANDLES) -> typing.Optional[Transaction]:
+    if args.direct or args.dry:
+        return None
+    transaction = Transaction(Transaction.default_journal_path(root), manifest, handles)
+    transaction.recover()
+    return transaction
 
-def file_copy(src: str, dst: str, remove: bool, force: bool, verbose: bool, ignore_errors: bool, dry: bool):
-    file_base(src, dst, remove, force, verbose, ignore_errors, dry, shutil.copy)
+
+def end_transaction(transaction: typing.Optional[Transaction], success: bool):
+    if transaction is None:
+        return
+    if success:
+        with PROFILER.phase('commit'):
+            transaction.commit()
+    else:
+        transaction.abort()
 
 
 
@@ -305,19 +2140,19 @@ class Watcher(object):
 
     # Look for changes
     def look(self):
-        file_changed = False
+        changed_files = []
 
         for i in range(len(self.filenames)):
             stamp = os.stat(self.filenames[i]).st_mtime
             if stamp != self._cached_stamps[i]:
                 self._cached_stamps[i] = stamp
-                file_changed = True
+                changed_files.append(self.filenames[i])
                 print('{} changed'.format(self.filenames[i]))
 
-        if file_changed:
+        if len(changed_files) > 0:
             print('Change detected...')
             if self.call_func_on_change is not None:
-                self.call_func_on_change()
+                self.call_func_on_change(changed_files)
 
     # Keep watching in a loop        
     def watch(self):
@@ -332,6 +2167,73 @@ class Watcher(object):
                 pass
 
 
+class InotifyWatcher:
+    """Blocks on Linux inotify events for a set of directories, only available on Linux"""
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    IN_MOVED_FROM = 0x00000040
+    IN_DELETE = 0x00000200
+
+    def __init__(self, mask: int = MASK):
+        import ctypes
+        import ctypes.util
+        import struct
+        self.mask = mask
+        self.event = struct.Struct('iIII')
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add_watch(self, directory: str):
+        if directory in self.watches.values():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask)
+        if wd < 0:
+            raise OSError(self.ctypes.get_errno(), 'Unable to watch ' + directory)
+        self.watches[wd] = directory
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self, timeout: typing.Optional[float]) -> typing.List[typing.Tuple[str, int]]:
+        import select
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        buffer = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = self.event.unpack_from(buffer, offset)
+            offset += self.event.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            directory = self.watches.get(wd)
+            if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                events.append(('', mask))
+            elif directory is not None:
+                events.append((os.path.join(directory, name), mask))
+        return events
+
+    def wait(self, debounce: float) -> typing.List[typing.Tuple[str, int]]:
+        """Wait for a change and then keep collecting until the editor has been quiet for debounce seconds"""
+        events = self.read(None)
+        while True:
+            more = self.read(debounce)
+            if len(more) == 0:
+                return events
+            events.extend(more)
+
+
 def matchlist_contains_file(terms: typing.List[str], path: str) -> bool:
     if len(terms) == 0:
         return True
@@ -341,54 +2243,325 @@ def matchlist_contains_file(terms: typing.List[str], path: str) -> bool:
     return True
 
 
-def has_atleast_one_class(classes: typing.List[str]) -> bool:
-    for c in classes:
-        if has_class(c):
-            return True
-    return False
+def get_trigrams(text: str) -> typing.Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class PathIndex:
+    """Trigram index over the source and home paths of plan entries, for search terms and suggestions"""
+
+    def __init__(self, entries: typing.List[PlanEntry]):
+        self.entries = entries
+        self.names = None
+        self.postings = {}
+        for i, e in enumerate(entries):
+            for t in get_trigrams(e.get_source()) | get_trigrams(e.home):
+                self.postings.setdefault(t, set()).add(i)
+
+    def candidates(self, term: str) -> typing.Optional[typing.Set[int]]:
+        """entries that contain every trigram of the term, None if the term is too short to say"""
+        if len(term) < 3:
+            return None
+        postings = sorted((self.postings.get(t, set()) for t in get_trigrams(term)), key=len)
+        result = set(postings[0])
+        for p in postings[1:]:
+            result &= p
+            if len(result) == 0:
+                break
+        return result
+
+    def search(self, terms: typing.List[str]) -> typing.List[PlanEntry]:
+        indices = None
+        for term in terms:
+            found = self.candidates(term)
+            if found is not None:
+                indices = found if indices is None else indices & found
+        if indices is None:
+            indices = range(len(self.entries))
+        matches = []
+        for i in sorted(indices):
+            e = self.entries[i]
+            if matchlist_contains_file(terms, e.get_source()) or matchlist_contains_file(terms, e.home):
+                matches.append(e)
+        return matches
 
+    @staticmethod
+    def get_names(entry: PlanEntry) -> typing.List[typing.Tuple[str, int]]:
+        """file names, with and without extension, and then the folder names closest to the file"""
+        names = []
+        for path in (entry.get_source(), entry.home):
+            parts = path.replace('\\', '/').split('/')
+            base = parts[-1]
+            names.append((base, 0))
+            names.append((os.path.splitext(base)[0].lstrip('.'), 0))
+            names.extend((p, 1) for p in parts[-3:-1])
+        return names
 
-def for_each_file(data: Data, install: bool, verb: str, search: typing.List[str], callback_copy):
-    total = 0
-    operated = 0
-    
-    for file in data.interesting_files:
-        if has_atleast_one_class(file.classes):
-            total += 1
-            home_path = file.home.get_abs_path()
-            src_path = os.path.join(get_src_folder(), file.src)
-            from_path = src_path if install else home_path
-            to_path = home_path if install else src_path
-            if matchlist_contains_file(search, from_path) or matchlist_contains_file(search, to_path):
-                operated += 1
-                callback_copy(from_path, to_path)
-    print('{} of {} {}.'.format(operated, total, verb))
+    @staticmethod
+    def rank(terms: typing.List[str], entries: typing.List[PlanEntry]) -> typing.List[PlanEntry]:
+        """entries where the terms hit the file name before those where they only hit a folder"""
+        def misses(e: PlanEntry) -> int:
+            names = os.path.basename(e.get_source()) + '/' + os.path.basename(e.home)
+            return sum(1 for t in terms if t not in names)
+        return sorted(entries, key=lambda e: (misses(e), len(e.home)))
+
+    def get_name_index(self) -> typing.Dict[str, typing.List[typing.Tuple[int, int]]]:
+        if self.names is None:
+            self.names = {}
+            for i, e in enumerate(self.entries):
+                for name, weight in PathIndex.get_names(e):
+                    self.names.setdefault(name, []).append((i, weight))
+        return self.names
+
+    def suggest(self, terms: typing.List[str], count: int = 5) -> typing.List[PlanEntry]:
+        # most entries share names, so each distinct name is measured once per term
+        scores = None
+        for term in terms:
+            limit = max(1, len(term) // 3)
+            best = {}
+            for name, users in self.get_name_index().items():
+                if abs(len(name) - len(term)) > limit:
+                    continue
+                distance = levenshtein_distance(term, name, limit)
+                if distance > limit:
+                    continue
+                for i, weight in users:
+                    if i not in best or (distance, weight) < best[i]:
+                        best[i] = (distance, weight)
+            if scores is None:
+                scores = best
+            else:
+                scores = {i: (d + best[i][0], w + best[i][1]) for i, (d, w) in scores.items() if i in best}
+        ranked = sorted((d, w, len(self.entries[i].home), i) for i, (d, w) in (scores or {}).items())
+        return [self.entries[r[3]] for r in ranked[:count]]
+
+
+def print_suggestions(suggestions: typing.List[PlanEntry]):
+    if len(suggestions) > 0:
+        print('Did you mean:')
+        for e in suggestions:
+            print('  ', e.get_source(), '->', e.home)
 
 
-def run_copy_command(args, data: Data, install: bool):
-    if args.remove:
-        clean_interesting(install, args.verbose, args.dry, data)
-    for_each_file(data, install, verb='copied', search=args.search,
-                  callback_copy=lambda from_path, to_path: file_copy(from_path, to_path, args.remove,
-                                                                     args.force, args.verbose, args.ignore_errors,
-                                                                     args.dry)
-                  )
+class ThreadOutput:
+    """
+    Stand-in for sys.stdout that lets worker threads write into a private buffer,
+    so their output can be replayed in plan order instead of interleaved.
+    """
 
-    if is_running('termite'):
-        print('Refreshing termite')
-        subprocess.run(['killall', '-USR1', 'termite'])
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
 
+    def write(self, text: str) -> int:
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
 
-def copy_command(args, data: Data, install: bool):
-    run_copy_command(args, data, install)
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
 
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_in_plan_order(jobs: int, tasks: typing.List[typing.Callable[[], None]]):
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            task()
+        return
 
-def run_print_command(args, data: Data):
+    output = ThreadOutput(sys.stdout)
+    # index of the first task that failed, tasks after it are skipped like the serial loop never reaches them
+    failed = [len(tasks)]
+    lock = threading.Lock()
+
+    def run(index: int, task):
+        with lock:
+            if index > failed[0]:
+                return '', None
+        output.local.buffer = io.StringIO()
+        try:
+            task()
+            return output.local.buffer.getvalue(), None
+        except BaseException as error:
+            with lock:
+                failed[0] = min(failed[0], index)
+            # error_detected() exits with SystemExit, hand it back to the main thread in order
+            return output.local.buffer.getvalue(), error
+        finally:
+            output.local.buffer = None
+
+    import concurrent.futures
+    sys.stdout = output
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(run, index, task) for index, task in enumerate(tasks)]
+            for future in futures:
+                text, error = future.result()
+                output.stream.write(text)
+                if error is not None:
+                    for pending in futures:
+                        pending.cancel()
+                    raise error
+    finally:
+        sys.stdout = output.stream
+
+
+def for_each_file(plan: Plan, install: bool, verb: str, search: typing.List[str], callback_copy, jobs: int = 1,
+                  suggest: bool = True):
+    total = len(plan.active_entries())
+    tasks = []
+
+    files = plan.index().search(search) if len(search) > 0 else plan.active_entries()
+    for file in files:
+        from_path = file.src if install else file.home
+        to_path = file.home if install else file.src
+        tasks.append(lambda f=from_path, t=to_path: callback_copy(f, t))
+    run_in_plan_order(jobs, tasks)
+    print('{} of {} {}.'.format(len(tasks), total, verb))
+    if len(tasks) == 0 and len(search) > 0 and suggest:
+        print_suggestions(plan.index().suggest(search))
+
+
+def run_copy_command(args, plan: Plan, install: bool):
+    mode = args.mode if install else 'copy'
+    manifest = Manifest.open_default()
+    handles = DirectoryHandles()
+    transaction = begin_transaction(args, manifest, None, handles)
+    # grab overwrites files in git, they don't need a snapshot
+    snapshot = begin_snapshot(args, manifest) if install else None
+    changed = []
+    generated = {e.src: e.template[0] for e in plan.entries if e.template is not None}
+    compares = {e.home: e.compare for e in plan.entries if e.compare is not None}
+    streamed = set()
+
+    def copy_file(from_path: str, to_path: str):
+        if not install and to_path in generated:
+            print('Skipping generated file, edit the template instead', generated[to_path])
+            return
+        if to_path in streamed:
+            return
+        if file_copy(from_path, to_path, args.remove, args.force, args.verbose, args.ignore_errors, args.dry,
+                     manifest, mode, transaction, snapshot, compares.get(to_path if install else from_path), handles):
+            changed.append(to_path)
+
+    success = False
+    try:
+        if args.remove:
+            clean_interesting(install, args.verbose, args.dry, plan, manifest, snapshot, handles)
+        if install and mode == 'copy':
+            streamed, written = install_submodules(args, plan, manifest, transaction, snapshot)
+            changed.extend(written)
+        for_each_file(plan, install, verb='copied', search=args.search, callback_copy=copy_file, jobs=args.jobs)
+        success = True
+    finally:
+        try:
+            end_transaction(transaction, success)
+        finally:
+            handles.close()
+            # after the commit or abort, so the snapshot only keeps the files that were replaced
+            end_snapshot(snapshot, args.verbose)
+        manifest.prune(plan)
+        manifest.save()
+
+    if install and not args.dry:
+        run_hooks(get_changed_hooks(plan, changed), args.jobs)
+
+
+def get_changed_hooks(plan: Plan, changed_homes: typing.Iterable[str]) -> typing.Dict[str, typing.List[str]]:
+    hooks = {e.home: e.hook for e in plan.entries if e.hook is not None}
+    changed = {}
+    for home in changed_homes:
+        hook = hooks.get(home)
+        if hook is not None:
+            changed.setdefault(hook, []).append(home)
+    return changed
+
+
+def run_root_install(args, plan: Plan) -> int:
+    """install the plan into every --root at once, sources are hashed once and shared by all roots"""
+    roots = [os.path.abspath(r) for r in args.root]
+    plans = [plan.rebase(r) for r in roots]
+    skipped = len(plan.entries) - len(plans[0].entries)
+    if skipped > 0:
+        print('Skipping {} files that are not installed into HOME'.format(skipped))
+    manifest = Manifest.open_default()
+
+    # hash every source up front so the roots don't race each other to hash the same file
+    sources = sorted({e.src for e in plan.active_entries() if file_exist(e.src)})
+    with PROFILER.phase('hash sources'):
+        run_in_plan_order(args.jobs, [lambda s=s: manifest.digest(s) for s in sources])
+
+    results = {}
+    snapshot = begin_snapshot(args, manifest)
+    # every thread has its own handles
+    handles = DirectoryHandles()
+
+    def install_root(root: str, root_plan: Plan):
+        print('Installing into', root)
+        counts = {'written': 0, 'unchanged': 0}
+        compares = {e.home: e.compare for e in root_plan.entries if e.compare is not None}
+        streamed = set()
+
+        def copy_file(from_path: str, to_path: str):
+            if to_path in streamed:
+                return
+            written = file_copy(from_path, to_path, args.remove, args.force, args.verbose, args.ignore_errors,
+                                args.dry, manifest, args.mode, transaction, snapshot, compares.get(to_path), handles)
+            counts['written' if written else 'unchanged'] += 1
+
+        transaction = begin_transaction(args, manifest, root, handles)
+        success = False
+        try:
+            if args.remove:
+                clean_interesting(True, args.verbose, args.dry, root_plan, manifest, snapshot, handles)
+            if args.mode == 'copy':
+                installed, written = install_submodules(args, root_plan, manifest, transaction, snapshot)
+                streamed.update(installed)
+                counts['written'] += len(written)
+                counts['unchanged'] += len(installed) - len(written)
+            for_each_file(root_plan, True, verb='copied', search=args.search, callback_copy=copy_file,
+                          suggest=False)
+            success = True
+        except (OSError, SystemExit) as e:
+            print('Install into', root, 'failed:', e)
+        finally:
+            end_transaction(transaction, success)
+        results[root] = (success, counts)
+        print()
+
+    # every root gets a thread of its own, the files in one root are installed in order
+    try:
+        run_in_plan_order(max(args.jobs, min(len(roots), 16)),
+                          [lambda r=r, p=p: install_root(r, p) for r, p in zip(roots, plans)])
+    finally:
+        handles.close()
+        end_snapshot(snapshot, args.verbose)
+    manifest.prune(plan, *plans)
+    manifest.save()
+
+    failed = 0
+    for root in roots:
+        success, counts = results.get(root, (False, {'written': 0, 'unchanged': 0}))
+        failed += 0 if success else 1
+        print('{:<8} {:>5} written {:>5} unchanged  {}'.format('ok' if success else 'FAILED', counts['written'],
+                                                               counts['unchanged'], root))
+    return 1 if failed > 0 else 0
+
+
+def copy_command(args, plan: Plan, install: bool):
+    run_copy_command(args, plan, install)
+
+
+def run_print_command(args, plan: Plan):
     def print_copied(from_path, to_path):
         print('Copying {} -> {}'.format(from_path, to_path))
         print()
 
-    for_each_file(data, True, verb='printed', search=args.search, callback_copy=print_copied)
+    for_each_file(plan, True, verb='printed', search=args.search, callback_copy=print_copied)
 
 
 def add_remove_commands(sub):
@@ -396,32 +2569,120 @@ def add_remove_commands(sub):
     add_dry(sub)
 
 
-def remove_command(use_home: bool, args, data: Data):
-    clean_interesting(use_home, args.verbose, args.dry, data)
-
-
-def print_file_infos(data: Data, verbose: bool):
-    def file_diff(absolute_home: str, absolute_source: str, diff_callback):
-        if verbose:
-            print()
-            print('Checking', absolute_home)
-        if not file_exist(absolute_home):
-            print("Missing in HOME", absolute_home)
-            return
-        if not file_exist(absolute_source):
-            print("Missing in SRC", absolute_source)
-            return
-        if not diff_callback(absolute_home, absolute_source):
-            print("Different", absolute_home, absolute_source)
-            return
+def remove_command(use_home: bool, args, plan: Plan):
+    manifest = Manifest.open_default()
+    snapshot = begin_snapshot(args, manifest) if use_home else None
+    handles = DirectoryHandles()
+    try:
+        removed = clean_interesting(use_home, args.verbose, args.dry, plan, manifest, snapshot, handles)
+        if use_home and not args.dry:
+            # the folders the install created, HOME itself and anything outside of it are left alone
+            for folder in handles.remove_empty_folders([os.path.dirname(p) for p in removed], get_home_folder()):
+                if args.verbose:
+                    print('Removed empty folder', folder)
+    finally:
+        handles.close()
+        end_snapshot(snapshot, args.verbose)
+        manifest.save()
+
+
+class FileState(Enum):
+    SAME = 'same'
+    DIFFERENT = 'different'
+    MISSING_HOME = 'missing-home'
+    MISSING_SRC = 'missing-src'
+    CLASS_FILTERED = 'class-filtered'
+
+    def is_drift(self) -> bool:
+        return self in (FileState.DIFFERENT, FileState.MISSING_HOME, FileState.MISSING_SRC)
+
+
+def get_file_state(file: PlanEntry, manifest: Manifest, handles: DirectoryHandles = PATH_HANDLES) -> FileState:
+    with PROFILER.phase('compare', file.home):
+        return get_file_state_uncounted(file, manifest, handles)
+
+
+def get_file_state_uncounted(file: PlanEntry, manifest: Manifest,
+                             handles: DirectoryHandles = PATH_HANDLES) -> FileState:
+    if not file.active:
+        return FileState.CLASS_FILTERED
+    home_lstat = handles.lstat(file.home)
+    is_link = home_lstat is not None and stat.S_ISLNK(home_lstat.st_mode)
+    home_stat = handles.stat(file.home) if is_link else home_lstat
+    if not is_regular(home_stat):
+        return FileState.MISSING_HOME
+    src_stat = handles.stat(file.src)
+    if not is_regular(src_stat):
+        return FileState.MISSING_SRC
+    if is_link and handles.readlink(file.home) == file.src:
+        return FileState.SAME
+    if manifest.is_unchanged(file.src, file.home, src_stat, home_lstat):
+        return FileState.SAME
+    if file_same(file.home, file.src, manifest.digests, home_stat, src_stat) or \
+            (file.compare is not None and structured_same(file.src, file.home, file.compare, manifest)):
+        manifest.record(file.src, file.home, src_stat, home_lstat)
+        return FileState.SAME
+    return FileState.DIFFERENT
+
+
+def get_file_states(plan: Plan, manifest: Manifest, jobs: int = 1) -> typing.List[typing.Tuple[PlanEntry, FileState]]:
+    handles = DirectoryHandles()
+    try:
+        if jobs <= 1:
+            states = [get_file_state(f, manifest, handles) for f in plan.entries]
+        else:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                states = list(pool.map(lambda f: get_file_state(f, manifest, handles), plan.entries))
+    finally:
+        handles.close()
+    return list(zip(plan.entries, states))
+
+
+def print_file_infos(plan: Plan, verbose: bool, jobs: int = 1, output_format: str = 'text') -> int:
+    states = query_daemon_states(plan)
+    manifest = None
+    if states is None:
+        manifest = Manifest.open_default()
+        try:
+            states = get_file_states(plan, manifest, jobs)
+        finally:
+            manifest.prune(plan)
+            manifest.save()
+
+    if output_format == 'json':
+        for file, state in states:
+            print(json.dumps({'state': state.value, 'home': file.home, 'src': file.src, 'classes': file.classes}))
+    elif output_format == 'porcelain':
+        for file, state in states:
+            print('{}\t{}\t{}'.format(state.value, file.home, file.src))
+    else:
+        total = 0
+        for file, state in states:
+            if state == FileState.CLASS_FILTERED:
+                continue
+            total += 1
+            if verbose:
+                print()
+                print('Checking', file.home)
+            if state == FileState.MISSING_HOME:
+                print("Missing in HOME", file.home)
+            elif state == FileState.MISSING_SRC:
+                print("Missing in SRC", file.src)
+            elif state == FileState.DIFFERENT:
+                print("Different", file.home, file.src)
+            elif verbose:
+                print("Same", file.home, file.src)
+        print('{} of {} status printed.'.format(total, total))
         if verbose:
-            print("Same", absolute_home, absolute_source)
+            print('Digest cache:', manifest.digests.hit_rate() if manifest is not None else 'answered by the daemon')
 
-    for_each_file(data, True, 'status printed', search=[],
-                  callback_copy=lambda source, home: file_diff(home, source, file_same))
+    return 1 if any(state.is_drift() for _, state in states) else 0
 
 
 def call_diff_app(left: str, right: str):
+    import platform
+    import subprocess
     s = platform.system()
     if s == 'Windows':
         winmerge = find_path('WinMergeU.exe', get_default_search_paths(), 'WinMerge')
@@ -446,9 +2707,90 @@ def call_diff_app(left: str, right: str):
         print("Unknown OS", s)
 
 
-def levenshtein_distance(s1: str, s2: str) -> int:
+def is_binary_file(path: str) -> bool:
+    # same sniffing as git and diff, a nul byte early in the file
+    try:
+        with open(path, 'rb') as f:
+            return b'\0' in f.read(8000)
+    except OSError:
+        return False
+
+
+def read_diff_lines(path: typing.Optional[str]) -> typing.List[str]:
+    if path is None or not file_exist(path):
+        return []
+    with open(path, 'r', encoding='utf-8', errors='replace', newline='') as f:
+        return f.readlines()
+
+
+def get_unified_diff(file: PlanEntry, manifest: Manifest) -> typing.Optional[str]:
+    """the diff from source to home, or None if the file hasn't drifted"""
+    state = get_file_state(file, manifest)
+    if not state.is_drift():
+        return None
+    src = file.src if state != FileState.MISSING_SRC else None
+    home = file.home if state != FileState.MISSING_HOME else None
+    if any(is_binary_file(p) for p in (src, home) if p is not None):
+        return 'Binary files {} and {} differ\n'.format(src or '/dev/null', home or '/dev/null')
+    import difflib
+    lines = difflib.unified_diff(read_diff_lines(src), read_diff_lines(home),
+                                 src or '/dev/null', home or '/dev/null')
+    out = io.StringIO()
+    for line in lines:
+        out.write(line)
+        if not line.endswith('\n'):
+            out.write('\n\\ No newline at end of file\n')
+    return out.getvalue()
+
+
+def open_diff_output(patch: typing.Optional[str], use_pager: bool):
+    """where to stream the diffs to, returns the stream and a function that closes it"""
+    if patch is not None and patch != '-':
+        f = open(patch, 'w', encoding='utf-8', newline='')
+        return f, f.close
+    if not use_pager or not sys.stdout.isatty():
+        return sys.stdout, sys.stdout.flush
+    import shlex
+    import subprocess
+    pager = os.getenv('PAGER') or ('more' if sys.platform == 'win32' else 'less -R')
+    try:
+        process = subprocess.Popen(shlex.split(pager), stdin=subprocess.PIPE, text=True, encoding='utf-8')
+    except OSError:
+        return sys.stdout, sys.stdout.flush
+
+    def close():
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+    return process.stdin, close
+
+
+def diff_all(files: typing.List[PlanEntry], jobs: int, out) -> int:
+    """write the diff of every drifted file to out in plan order, returns the number of drifted files"""
+    manifest = Manifest.open_default()
+    drifted = 0
+    try:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            # map keeps the order and hands back each diff as soon as it and the ones before it are done
+            for text in pool.map(lambda f: get_unified_diff(f, manifest), files):
+                if text is None:
+                    continue
+                drifted += 1
+                out.write(text)
+    finally:
+        manifest.save()
+    return drifted
+
+
+def levenshtein_distance(s1: str, s2: str, limit: typing.Optional[int] = None) -> int:
+    """edit distance, if a limit is given anything above it is reported as limit + 1 without finishing"""
     if len(s1) > len(s2):
         s1, s2 = s2, s1
+    if limit is not None and len(s2) - len(s1) > limit:
+        return limit + 1
 
     distances = range(len(s1) + 1)
     for i2, c2 in enumerate(s2):
@@ -459,51 +2801,986 @@ def levenshtein_distance(s1: str, s2: str) -> int:
             else:
                 distances_.append(1 + min((distances[i1], distances[i1 + 1], distances_[-1])))
         distances = distances_
+        if limit is not None and min(distances) > limit:
+            return limit + 1
     return distances[-1]
 
 
+########################################################################################################################
+# Status daemon
+
+def get_daemon_socket_path() -> str:
+    # keep in sync with scripts/dotstatus.py and zsh_custom/themes/madeso.zsh-theme
+    if os.getenv('DOTLIB_SOCKET'):
+        return os.getenv('DOTLIB_SOCKET')
+    if os.getenv('XDG_RUNTIME_DIR'):
+        return os.path.join(os.getenv('XDG_RUNTIME_DIR'), 'dotlib.sock')
+    return os.path.join(get_cache_folder(), 'daemon.sock')
+
+
+def query_daemon(request: str, timeout: float = 0.5) -> typing.Optional[str]:
+    """send a one line request to the daemon, None if it isn't running"""
+    path = get_daemon_socket_path()
+    # status runs this on every call, only pay for the socket module when there is a daemon to talk to
+    if not os.path.exists(path):
+        return None
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(path)
+            client.sendall(request.encode('utf-8') + b'\n')
+            chunks = []
+            while True:
+                chunk = client.recv(64 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return b''.join(chunks).decode('utf-8')
+    except OSError:
+        return None
+
+
+def query_daemon_states(plan: Plan) -> typing.Optional[typing.List[typing.Tuple[PlanEntry, FileState]]]:
+    """the file states from the daemon, if it is running with the same plan"""
+    if plan.key is None:
+        return None
+    response = query_daemon('status ' + plan.key)
+    if response is None or response.startswith('error'):
+        return None
+    states = []
+    for line in response.splitlines():
+        record = json.loads(line)
+        state = FileState(record['state'])
+        states.append((PlanEntry(record['src'], record['home'], record['classes'], state != FileState.CLASS_FILTERED,
+                                 None), state))
+    return states
+
+
+class StatusDaemon:
+    """Keeps the state of every file up to date from inotify events and answers queries over a unix socket"""
+    MASK = InotifyWatcher.MASK | InotifyWatcher.IN_DELETE | InotifyWatcher.IN_MOVED_FROM
+
+    def __init__(self, plan: Plan, debounce: float):
+        self.plan = plan
+        self.debounce = debounce
+        self.manifest = Manifest.open_default()
+        self.states = {}
+        self.by_path = {}
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.running = True
+
+    def get_sources(self) -> typing.List[str]:
+        # editing the rules in dotfiles.py or dotlib.py means the plan has to be evaluated again
+        return [os.path.abspath(sys.modules[self.plan.source.__module__].__file__), os.path.abspath(__file__)] \
+            if callable(self.plan.source) else []
+
+    def load(self):
+        """compute the state of every file and watch every folder they are in"""
+        render_templates(self.plan.entries)
+        states = {e.home: get_file_state(e, self.manifest) for e in self.plan.entries}
+        by_path = {}
+        for e in self.plan.entries:
+            for p in (e.home, e.src, e.get_source()):
+                by_path.setdefault(p, []).append(e)
+        with self.lock:
+            self.states = states
+            self.by_path = by_path
+        if self.watcher is not None:
+            folders = set(os.path.dirname(p) for p in by_path) | set(self.plan.scanned_dirs) \
+                | set(os.path.dirname(p) for p in self.get_sources())
+            for folder in sorted(folders):
+                # a folder that doesn't exist yet is checked on every query instead
+                if os.path.isdir(folder):
+                    try:
+                        self.watcher.add_watch(folder)
+                    except OSError as e:
+                        print(e)
+        self.manifest.save()
+
+    def reload(self):
+        print('Reloading plan')
+        self.plan = self.plan.reload()
+        self.load()
+
+    def update(self, paths: typing.Iterable[str]):
+        entries = {}
+        for p in paths:
+            for e in self.by_path.get(p, []):
+                entries[e.home] = e
+        render_templates(entries.values())
+        states = {home: get_file_state(e, self.manifest) for home, e in entries.items()}
+        with self.lock:
+            self.states.update(states)
+        self.manifest.save()
+
+    def watch(self):
+        while self.running:
+            events = self.watcher.wait(self.debounce)
+            paths = set()
+            reload = False
+            for path, mask in events:
+                if path == '' or path in self.get_sources():
+                    reload = True
+                elif path in self.by_path:
+                    paths.add(path)
+                elif mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO) \
+                        and os.path.dirname(path) in self.plan.scanned_dirs:
+                    reload = True
+            try:
+                if reload:
+                    self.reload()
+                elif len(paths) > 0:
+                    self.update(paths)
+            except Exception as e:
+                print('Unable to update file states:', e)
+
+    def poll(self):
+        # without inotify everything is checked again every few seconds
+        while self.running:
+            time.sleep(2)
+            self.update(list(self.by_path))
+
+    def get_states(self) -> typing.List[typing.Tuple[PlanEntry, FileState]]:
+        with self.lock:
+            states = dict(self.states)
+        # files in folders that didn't exist when they were watched
+        watched = set(self.watcher.watches.values()) if self.watcher is not None else set()
+        unwatched = [e for e in self.plan.entries if os.path.dirname(e.home) not in watched]
+        for e in unwatched:
+            states[e.home] = get_file_state(e, self.manifest)
+        return [(e, states[e.home]) for e in self.plan.entries]
+
+    def answer(self, request: str) -> str:
+        command, _, key = request.strip().partition(' ')
+        if command == 'ping':
+            return 'pong\n'
+        if command == 'stop':
+            self.running = False
+            return 'stopping\n'
+        if command == 'drift-count':
+            return '{}\n'.format(sum(1 for _, state in self.get_states() if state.is_drift()))
+        if command == 'status':
+            if key != '' and key != self.plan.key:
+                return 'error plan has changed\n'
+            return ''.join(json.dumps({'state': state.value, 'home': file.home, 'src': file.src,
+                                       'classes': file.classes}) + '\n' for file, state in self.get_states())
+        return 'error unknown command {}\n'.format(command)
+
+    def serve(self, path: str):
+        import socket
+        if query_daemon('ping') is not None:
+            print('The daemon is already running on', path)
+            return 1
+        remove_existing(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            self.watcher = InotifyWatcher(StatusDaemon.MASK)
+            target = self.watch
+        except (OSError, AttributeError) as e:
+            print('inotify not available, falling back to polling:', e)
+            target = self.poll
+        self.load()
+        threading.Thread(target=target, daemon=True).start()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(path)
+            os.chmod(path, 0o600)
+            server.listen(16)
+            print('Watching {} files, listening on {}'.format(len(self.plan.entries), path))
+            while self.running:
+                connection, _ = server.accept()
+                with connection:
+                    try:
+                        connection.settimeout(1)
+                        request = connection.makefile('r', encoding='utf-8').readline()
+                        connection.sendall(self.answer(request).encode('utf-8'))
+                    except (OSError, ValueError) as e:
+                        print('Bad request:', e)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            remove_existing(path)
+        return 0
+
+
+########################################################################################################################
+# Startup benchmark
+
+STARTUP_TOLERANCE = 0.2
+# slowdowns smaller than this are noise, even when they are a large part of a fast startup
+STARTUP_THRESHOLD_MS = 20.0
+# clock, elapsed or self+sourced, self for sourced scripts, and the event or script
+STARTUPTIME_LINE = re.compile(r'^(\d+\.\d+)\s+(\d+\.\d+)(?:\s+(\d+\.\d+))?:\s+(.*)$')
+# num) calls total ms, total %, self ms, self avg ms, self % and the function
+ZPROF_LINE = re.compile(r'^\s*\d+\)\s+\d+\s+[\d.]+\s+[\d.]+\s+[\d.]+%\s+([\d.]+)\s+[\d.]+\s+[\d.]+%\s+(\S.*)$')
+
+
+def shorten_home(name: str) -> str:
+    return name.replace(get_home_folder(), '~')
+
+
+def parse_startuptime(text: str) -> typing.Dict[str, float]:
+    """milliseconds per sourced script or startup event from a vim or nvim --startuptime log"""
+    items = {}
+    for line in text.splitlines():
+        match = STARTUPTIME_LINE.match(line)
+        if match is None:
+            continue
+        _, elapsed, self_time, name = match.groups()
+        name = shorten_home(name.strip())
+        items[name] = items.get(name, 0.0) + float(self_time if self_time is not None else elapsed)
+    return items
+
+
+def parse_zprof(text: str) -> typing.Dict[str, float]:
+    """self milliseconds per function from zprof"""
+    items = {}
+    for line in text.splitlines():
+        match = ZPROF_LINE.match(line)
+        if match is not None:
+            items[match.group(2).strip()] = float(match.group(1))
+    return items
+
+
+def time_command(command: typing.List[str], env: typing.Optional[typing.Dict[str, str]] = None) -> float:
+    import subprocess
+    start = time.perf_counter()
+    subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env,
+                   timeout=60, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def run_zsh_startup(program: str, temp: str) -> typing.Tuple[float, typing.Dict[str, float]]:
+    import subprocess
+    total = time_command([program, '-i', '-c', 'exit'])
+    # a second start with zprof loaded before the real .zshrc, so the profiler doesn't slow down the timed start
+    zdotdir = os.path.join(temp, 'zsh')
+    home = os.getenv('ZDOTDIR', get_home_folder())
+    os.makedirs(zdotdir, exist_ok=True)
+    with open(os.path.join(zdotdir, '.zshenv'), 'w', encoding='utf-8') as f:
+        f.write('[[ -f "{0}/.zshenv" ]] && source "{0}/.zshenv"\n'.format(home))
+    with open(os.path.join(zdotdir, '.zshrc'), 'w', encoding='utf-8') as f:
+        f.write('zmodload zsh/zprof\nZDOTDIR="{0}"\nsource "{0}/.zshrc"\n'.format(home))
+    result = subprocess.run([program, '-i', '-c', 'zprof'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, env=dict(os.environ, ZDOTDIR=zdotdir), text=True, timeout=60)
+    return total, parse_zprof(result.stdout)
+
+
+def run_vim_startup(program: str, temp: str, nvim: bool) -> typing.Tuple[float, typing.Dict[str, float]]:
+    log = os.path.join(temp, 'startuptime.log')
+    # vim appends to the log
+    remove_existing(log)
+    if nvim:
+        command = [program, '--headless', '--startuptime', log, '+qa!']
+    else:
+        command = [program, '--not-a-term', '--startuptime', log, '-c', 'qa!']
+    total = time_command(command)
+    with open(log, 'r', encoding='utf-8', errors='replace') as f:
+        return total, parse_startuptime(f.read())
+
+
+STARTUP_TOOLS = {
+    'zsh': run_zsh_startup,
+    'nvim': lambda program, temp: run_vim_startup(program, temp, True),
+    'vim': lambda program, temp: run_vim_startup(program, temp, False),
+}
+
+
+def bench_startup(tools: typing.List[str], runs: int) -> typing.Dict[str, dict]:
+    """median milliseconds to start each tool, and per script or function, with the configs installed in HOME"""
+    import shutil
+    import statistics
+    import subprocess
+    import tempfile
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='dotlib-startup-') as temp:
+        for name in tools:
+            program = shutil.which(name)
+            if program is None:
+                print(name, 'not found, skipping')
+                continue
+            totals = []
+            items = {}
+            for _ in range(runs):
+                try:
+                    total, timings = STARTUP_TOOLS[name](program, temp)
+                except (OSError, subprocess.SubprocessError) as e:
+                    print('Unable to start', name, e)
+                    break
+                totals.append(total)
+                for item, ms in timings.items():
+                    items.setdefault(item, []).append(ms)
+            if len(totals) > 0:
+                results[name] = {
+                    'total': statistics.median(totals),
+                    'runs': len(totals),
+                    'items': {item: statistics.median(times) for item, times in items.items()},
+                }
+    return results
+
+
+def is_startup_regression(ms: float, old: typing.Optional[float], tolerance: float, threshold: float) -> bool:
+    return old is not None and ms - old > threshold and ms > old * (1 + tolerance)
+
+
+def print_startup_results(results: typing.Dict[str, dict], baseline: typing.Dict[str, dict], tolerance: float,
+                          threshold: float, top: int) -> typing.List[str]:
+    """print the medians next to the baseline, returns the tools that got slower"""
+    regressions = []
+
+    def change(ms: float, old: typing.Optional[float]) -> str:
+        return '' if old is None else '{:+.1f} ms'.format(ms - old)
+
+    for name, result in results.items():
+        old = baseline.get(name, {})
+        slower = is_startup_regression(result['total'], old.get('total'), tolerance, threshold)
+        if slower:
+            regressions.append(name)
+        print('{:<6} {:>8.1f} ms {:>12} {}'.format(name, result['total'], change(result['total'], old.get('total')),
+                                                  '!' if slower else ''))
+        old_items = old.get('items', {})
+        # the slowest items, and the ones that slowed down the most since the baseline
+        slowest = sorted(result['items'].items(), key=lambda i: -i[1])[:top]
+        grown = sorted(((i, ms) for i, ms in result['items'].items() if i in old_items),
+                       key=lambda i: old_items[i[0]] - i[1])[:top]
+        for item, ms in slowest + [g for g in grown if g not in slowest and g[1] - old_items[g[0]] > threshold]:
+            label = item if len(item) <= 48 else '...' + item[-45:]
+            print('    {:<48} {:>8.1f} ms {:>12}'.format(label, ms, change(ms, old_items.get(item))))
+    return regressions
+
+
+def default_startup_baseline_path() -> str:
+    return os.path.join(get_cache_folder(), 'startup-baseline.json')
+
+
+########################################################################################################################
+# Bundles
+
+BUNDLE_VERSION = 1
+BUNDLE_MANIFEST = 'dotlib-bundle.json'
+# files are stored relative to HOME under this folder, after the manifest
+BUNDLE_FILES = 'home/'
+# suffix to tarfile compression, zst is piped through the zstd binary
+BUNDLE_TAR_SUFFIXES = {
+    '.tar': '',
+    '.tar.gz': 'gz', '.tgz': 'gz',
+    '.tar.xz': 'xz', '.txz': 'xz',
+    '.tar.zst': 'zst', '.tzst': 'zst',
+}
+
+
+def get_bundle_format(path: str) -> typing.Optional[str]:
+    """pyz for a self extracting zipapp, otherwise the tar compression, None if the suffix isn't known"""
+    name = path.lower()
+    if name.endswith('.pyz'):
+        return 'pyz'
+    for suffix, compression in BUNDLE_TAR_SUFFIXES.items():
+        if name.endswith(suffix):
+            return compression
+    return None
+
+
+def is_safe_bundle_path(relative: str) -> bool:
+    parts = relative.split('/')
+    return not relative.startswith('/') and all(p not in ('', '.', '..') for p in parts)
+
+
+def get_bundle_files(plan: Plan) -> typing.List[typing.Tuple[PlanEntry, str]]:
+    """the active files and their path relative to HOME, files outside of HOME are left out"""
+    home = get_home_folder()
+    files = []
+    for e in plan.active_entries():
+        relative = os.path.relpath(e.home, home)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            continue
+        if not file_exist(e.src):
+            print('Missing file', e.src)
+            continue
+        files.append((e, relative.replace(os.sep, '/')))
+    return files
+
+
+def make_bundle_manifest(files: typing.List[typing.Tuple[PlanEntry, str]], classes: typing.Iterable[str],
+                         manifest: Manifest, jobs: int) -> dict:
+    # hashed up front so the manifest can be written before the files and unbundle can verify them as they stream by
+    run_in_plan_order(jobs, [lambda e=e: manifest.digest(e.src) for e, _ in files])
+    src_folder = get_src_folder()
+    records = []
+    for e, relative in files:
+        st = os.stat(e.src)
+        records.append({
+            'path': relative,
+            'source': os.path.relpath(e.get_source(), src_folder).replace(os.sep, '/'),
+            'generated': e.template is not None,
+            'digest': manifest.digest(e.src, st),
+            'size': st.st_size,
+            'mode': st.st_mode & 0o7777,
+        })
+    return {'version': BUNDLE_VERSION, 'classes': sorted(classes), 'host': get_host_name(), 'created': time.time(),
+            'files': records}
+
+
+@contextlib.contextmanager
+def open_bundle_tar(path: str, compression: str, write: bool):
+    """a streaming tarfile, only one pass over the members is possible"""
+    import tarfile
+    if compression != 'zst':
+        with tarfile.open(path, 'w|' + compression if write else 'r|*') as tar:
+            yield tar
+        return
+    import subprocess
+    with contextlib.ExitStack() as stack:
+        if write:
+            out = stack.enter_context(open(path, 'wb'))
+            process = subprocess.Popen(['zstd', '-q', '-c'], stdin=subprocess.PIPE, stdout=out)
+            pipe = process.stdin
+        else:
+            process = subprocess.Popen(['zstd', '-q', '-d', '-c', path], stdout=subprocess.PIPE)
+            pipe = process.stdout
+        try:
+            with tarfile.open(fileobj=pipe, mode='w|' if write else 'r|') as tar:
+                yield tar
+        finally:
+            pipe.close()
+            if process.wait() != 0:
+                raise OSError('zstd failed with exit code {}'.format(process.returncode))
+
+
+def write_bundle(path: str, kind: str, bundle_manifest: dict, files: typing.List[typing.Tuple[PlanEntry, str]],
+                 verbose: bool):
+    data = json.dumps(bundle_manifest, indent=1).encode('utf-8')
+    if kind == 'pyz':
+        import zipfile
+        with open(path, 'wb') as out:
+            out.write(b'#!/usr/bin/env python3\n')
+            with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+                bundle.write(os.path.join(get_src_folder(), 'scripts', 'unbundle.py'), '__main__.py')
+                bundle.writestr(BUNDLE_MANIFEST, data)
+                for e, relative in files:
+                    if verbose:
+                        print('Adding', e.src)
+                    bundle.write(e.src, BUNDLE_FILES + relative)
+        os.chmod(path, 0o755)
+        return
+
+    import tarfile
+    with open_bundle_tar(path, kind, True) as tar:
+        info = tarfile.TarInfo(BUNDLE_MANIFEST)
+        info.size = len(data)
+        info.mtime = int(bundle_manifest['created'])
+        tar.addfile(info, io.BytesIO(data))
+        for (e, relative), record in zip(files, bundle_manifest['files']):
+            if verbose:
+                print('Adding', e.src)
+            with open(e.src, 'rb') as f:
+                st = os.fstat(f.fileno())
+                info = tarfile.TarInfo(BUNDLE_FILES + relative)
+                info.size = st.st_size
+                info.mtime = int(st.st_mtime)
+                info.mode = record['mode']
+                tar.addfile(info, f)
+
+
+def read_bundle(path: str, kind: str) -> typing.Iterator[typing.Tuple[str, typing.BinaryIO]]:
+    """the name and content of every file in the bundle, in the order they were written"""
+    if kind == 'pyz':
+        import zipfile
+        with zipfile.ZipFile(path) as bundle:
+            for info in bundle.infolist():
+                if not info.is_dir():
+                    with bundle.open(info) as f:
+                        yield info.filename, f
+        return
+    with open_bundle_tar(path, kind, False) as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, tar.extractfile(member)
+
+
+def extract_file(stream: typing.BinaryIO, dst: str, mode: int, expected_digest: typing.Optional[str] = None,
+                 handles: DirectoryHandles = PATH_HANDLES) -> str:
+    """write the stream to dst through a temporary file and return its digest, the same as file_digest(dst)"""
+    import hashlib
+    handles.makedirs(os.path.dirname(dst))
+    temp = dst + Transaction.NEW_SUFFIX
+    handles.remove_existing(temp)
+    h = hashlib.sha256()
+    with handles.open_write(temp) as out:
+        for block in iter(lambda: stream.read(1024 * 1024), b''):
+            h.update(block)
+            out.write(block)
+        chmod_open_file(out, temp, mode)
+    if expected_digest is not None and h.hexdigest() != expected_digest:
+        handles.unlink(temp)
+        raise OSError('{} is damaged'.format(dst))
+    handles.replace(temp, dst)
+    return h.hexdigest()
+
+
+def unbundle(args, path: str, root: str) -> int:
+    kind = get_bundle_format(path)
+    manifest = Manifest.open_default()
+    # a root other than HOME is a fresh tree, like install --root
+    snapshot = begin_snapshot(args, manifest) if root == get_home_folder() else None
+    src_folder = get_src_folder()
+    records = None
+    counts = {'written': 0, 'unchanged': 0}
+    try:
+        for name, stream in read_bundle(path, kind):
+            if name == BUNDLE_MANIFEST:
+                loaded = json.load(stream)
+                if loaded.get('version') != BUNDLE_VERSION:
+                    print('Unsupported bundle version', loaded.get('version'))
+                    return 1
+                records = {r['path']: r for r in loaded['files']}
+                print('Unbundling {} files for {} into {}'.format(len(records), ', '.join(loaded['classes']), root))
+                continue
+            if not name.startswith(BUNDLE_FILES):
+                # the self extractor of a pyz
+                continue
+            if records is None:
+                print('The bundle manifest must come before the files')
+                return 1
+            relative = name[len(BUNDLE_FILES):]
+            record = records.get(relative)
+            if record is None or not is_safe_bundle_path(relative):
+                print('Skipping unexpected file', name)
+                continue
+            dst = os.path.join(root, *relative.split('/'))
+            if not args.force and file_exist(dst) and os.path.getsize(dst) == record['size'] \
+                    and manifest.digest(dst) == record['digest']:
+                if args.verbose:
+                    print('Files are the same', name, dst)
+                counts['unchanged'] += 1
+            else:
+                print('Extracting', name, 'to', dst)
+                counts['written'] += 1
+                if args.dry:
+                    continue
+                if snapshot is not None:
+                    snapshot.add(dst, True)
+                extract_file(stream, dst, record['mode'], record['digest'])
+            if not args.dry:
+                if record['generated']:
+                    src = get_generated_path(os.path.join(get_home_folder(), *relative.split('/')))
+                else:
+                    # normalized so a source outside of the checkout matches the path in the plan
+                    src = os.path.normpath(os.path.join(src_folder, *record['source'].split('/')))
+                manifest.record_extracted(src, dst, record['digest'], record['size'])
+    finally:
+        end_snapshot(snapshot, args.verbose)
+        manifest.save()
+    print('{} written, {} unchanged'.format(counts['written'], counts['unchanged']))
+    return 0
+
+
+########################################################################################################################
+# Submodules
+
+def get_git_dir(folder: str) -> typing.Optional[str]:
+    """the .git folder of a checkout, following the gitdir: file a submodule has"""
+    dot_git = os.path.join(folder, '.git')
+    if os.path.isdir(dot_git):
+        return dot_git
+    try:
+        with open(dot_git, 'r', encoding='utf-8') as f:
+            line = f.read().strip()
+    except OSError:
+        return None
+    if not line.startswith('gitdir:'):
+        return None
+    return os.path.normpath(os.path.join(folder, line[len('gitdir:'):].strip()))
+
+
+def get_submodule_commit(folder: str) -> typing.Optional[str]:
+    """the commit checked out in folder, read from the files in .git so no git process is needed"""
+    git_dir = get_git_dir(folder)
+    if git_dir is None:
+        return None
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r', encoding='utf-8') as f:
+            head = f.read().strip()
+        if not head.startswith('ref:'):
+            return head if len(head) >= 40 else None
+        ref = head[len('ref:'):].strip()
+        try:
+            with open(os.path.join(git_dir, *ref.split('/')), 'r', encoding='utf-8') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+        with open(os.path.join(git_dir, 'packed-refs'), 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except OSError:
+        pass
+    return None
+
+
+def get_submodule_key(commit: str, files: typing.List[PlanEntry]) -> str:
+    # an exclude or .gitignore that changes the files changes the key too
+    import hashlib
+    return commit + ':' + hashlib.sha256('\n'.join(f.home for f in files).encode('utf-8')).hexdigest()[:16]
+
+
+def stream_submodule(folder: str, commit: str, files: typing.Dict[str, PlanEntry], args, manifest: Manifest,
+                     transaction: typing.Optional[Transaction],
+                     snapshot: typing.Optional[Snapshot]) -> typing.Tuple[typing.Set[str], typing.List[str]]:
+    """
+    install the files from the commit with git archive, returns the homes that were installed, or staged in the
+    transaction, and written
+    """
+    import hashlib
+    import subprocess
+    import tarfile
+    handled = set()
+    written = []
+    # tar.umask=user gives the files the same permissions as a checkout
+    process = subprocess.Popen(['git', '-c', 'tar.umask=user', '-C', folder, 'archive', '--format=tar', commit],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+            for member in tar:
+                entry = files.get(member.name)
+                # symlinks and files that aren't committed are copied one by one
+                if entry is None or not member.isfile():
+                    continue
+                handled.add(entry.home)
+                data = tar.extractfile(member).read()
+                digest = hashlib.sha256(data).hexdigest()
+                if not args.force and manifest.has_installed(entry.home, digest):
+                    if args.verbose:
+                        print('Files are the same', entry.src, entry.home)
+                    continue
+                print('Copying file', entry.src, 'to', entry.home)
+                written.append(entry.home)
+                if args.dry:
+                    continue
+                if snapshot is not None:
+                    snapshot.add(entry.home, True)
+                with PROFILER.phase('copy', entry.home):
+                    if transaction is not None:
+                        transaction.stage(entry.src, entry.home,
+                                          lambda _, temp, h, d=data, m=member.mode: extract_file(io.BytesIO(d), temp, m, None, h),
+                                          True, digest)
+                        continue
+                    extract_file(io.BytesIO(data), entry.home, member.mode, digest)
+                manifest.record_extracted(entry.src, entry.home, digest, len(data))
+    except tarfile.ReadError:
+        # git archive of an empty tree has no members, a failing git is reported below
+        pass
+    finally:
+        process.stdout.close()
+        error = process.stderr.read().decode('utf-8', errors='replace').strip()
+        process.stderr.close()
+        if process.wait() != 0:
+            raise OSError('git archive failed: ' + error)
+    return handled, written
+
+
+def install_submodules(args, plan: Plan, manifest: Manifest, transaction: typing.Optional[Transaction],
+                       snapshot: typing.Optional[Snapshot]) -> typing.Tuple[typing.Set[str], typing.List[str]]:
+    """
+    install the files that come from submodules, a submodule at the same commit as the last install is skipped
+    after an lstat of its files. Returns the homes that need no copy and the ones that were written.
+    """
+    groups = {}
+    for e in plan.index().search(args.search) if len(args.search) > 0 else plan.active_entries():
+        if e.submodule is not None:
+            groups.setdefault(e.submodule, []).append(e)
+    handled = set()
+    written = []
+    for folder, files in groups.items():
+        commit = get_submodule_commit(folder)
+        if commit is None:
+            print('Unable to find the commit of submodule', folder, 'copying the files one by one')
+            continue
+        relatives = {os.path.relpath(e.src, folder).replace(os.sep, '/'): e for e in files}
+        relative, first = next(iter(relatives.items()))
+        home_folder = first.home[:-len(relative) - 1]
+        key = get_submodule_key(commit, files)
+        if not args.force and manifest.submodules.get(home_folder) == key:
+            if all(manifest.is_untouched(e.home) for e in files):
+                if args.verbose:
+                    print('Submodule unchanged at', commit[:12], folder)
+                handled.update(e.home for e in files)
+                continue
+            # a file was edited or removed in HOME, stream the commit again to repair it
+            if not args.dry:
+                manifest.set_submodule(home_folder, None)
+        with PROFILER.phase('submodule', folder):
+            try:
+                installed, changed = stream_submodule(folder, commit, relatives, args, manifest, transaction,
+                                                      snapshot)
+            except OSError as e:
+                print('Unable to install submodule', folder, e)
+                continue
+        handled.update(installed)
+        written.extend(changed)
+        # files outside of the commit are copied one by one every time, and a search may only install a few
+        if not args.dry and len(installed) == len(files) and len(args.search) == 0:
+            manifest.set_submodule(home_folder, key)
+    return handled, written
+
+
 ########################################################################################################################
 # Command functions
 
-def handle_install(args, data: Data):
-    copy_command(args, data, True)
+def handle_install(args, plan: Plan):
+    if len(args.root) > 0:
+        return run_root_install(args, plan)
+    if args.bench_startup <= 0 or args.dry:
+        copy_command(args, plan, True)
+        return
+    before = bench_startup(list(STARTUP_TOOLS), args.bench_startup)
+    copy_command(args, plan, True)
+    after = bench_startup(list(STARTUP_TOOLS), args.bench_startup)
+    print()
+    print('Startup after the install, compared to before:')
+    regressions = print_startup_results(after, before, STARTUP_TOLERANCE, STARTUP_THRESHOLD_MS, 5)
+    if len(regressions) > 0:
+        print('The install made startup slower:', ', '.join(regressions))
+        return 1
+
+
+def get_watched_files(args, plan: Plan) -> typing.Dict[str, PlanEntry]:
+    return {f.get_source(): f for f in plan.active_entries()
+            if matchlist_contains_file(args.search, f.get_source()) or matchlist_contains_file(args.search, f.home)}
 
 
-def handle_watch(args, data: Data):
-    # todo(Gustav): make sure this works...
-    files = [os.path.join(get_src_folder(), f.src) for f in data.files]
+def handle_watch(args, plan: Plan):
+    manifest = Manifest.open_default()
+    files = get_watched_files(args, plan)
 
-    def on_action():
+    def install_files(entries: typing.Iterable[PlanEntry]):
         print()
-        copy_command(args, data, True)
+        entries = list(entries)
+        render_templates(entries, args.verbose)
+        handles = DirectoryHandles()
+        transaction = begin_transaction(args, manifest, None, handles)
+        snapshot = begin_snapshot(args, manifest)
+        changed = {}
+        success = False
+        try:
+            for f in entries:
+                if file_copy(f.src, f.home, args.remove, args.force, args.verbose, args.ignore_errors, args.dry,
+                             manifest, args.mode, transaction, snapshot, f.compare, handles) and f.hook is not None:
+                    changed.setdefault(f.hook, []).append(f.home)
+            success = True
+        finally:
+            try:
+                end_transaction(transaction, success)
+            finally:
+                handles.close()
+                end_snapshot(snapshot, args.verbose)
+        manifest.save()
+        if not args.dry:
+            run_hooks(changed, args.jobs)
         print()
 
-    watcher = Watcher(files, on_action)
-    watcher.watch()
+    try:
+        watcher = InotifyWatcher()
+    except (OSError, AttributeError) as e:
+        print('inotify not available, falling back to polling:', e)
+        Watcher(list(files.keys()), lambda changed: install_files(files[f] for f in changed)).watch()
+        return
+
+    def watch_directories():
+        for d in sorted(set(os.path.dirname(f) for f in files) | set(plan.scanned_dirs)):
+            try:
+                watcher.add_watch(d)
+            except OSError as e:
+                print(e)
+
+    watch_directories()
+    print('Watching {} files in {} directories'.format(len(files), len(watcher.watches)))
+    try:
+        while True:
+            events = watcher.wait(args.debounce / 1000.0)
+            changed = set()
+            rescan = False
+            for path, mask in events:
+                if path == '':
+                    print('Too many changes, reinstalling everything')
+                    changed.update(files.keys())
+                elif path in files:
+                    changed.add(path)
+                elif mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO) \
+                        and os.path.dirname(path) in plan.scanned_dirs:
+                    rescan = True
+            if rescan:
+                plan = plan.reload()
+                new_files = get_watched_files(args, plan)
+                changed.update(f for f in new_files if f not in files)
+                files = new_files
+                watch_directories()
+            if len(changed) > 0:
+                install_files(files[f] for f in sorted(changed) if f in files)
+    except KeyboardInterrupt:
+        print('\nDone')
+    finally:
+        watcher.close()
+
+
+def handle_print(args, plan: Plan):
+    run_print_command(args, plan)
+
+
+def handle_uninstall(args, plan: Plan):
+    remove_command(True, args, plan)
+
+
+def restore_snapshot_file(store: SnapshotStore, dst: str, entry: typing.Optional[dict]):
+    if entry is None:
+        # the file didn't exist before
+        remove_existing(dst)
+        return
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    temp = dst + Transaction.NEW_SUFFIX
+    remove_existing(temp)
+    if 'link' in entry:
+        os.symlink(entry['link'], temp)
+    else:
+        source = store.object_path(entry['digest'])
+        if file_digest(source) != entry['digest']:
+            raise OSError('Snapshot of {} is damaged'.format(dst))
+        import shutil
+        # a copy and not a link, editing the restored file must not change the stored one
+        shutil.copyfile(source, temp)
+        os.chmod(temp, entry['mode'])
+    os.replace(temp, dst)
+
+
+def handle_rollback(args, plan: typing.Optional[Plan]):
+    store = SnapshotStore(SnapshotStore.default_path())
+    if args.list:
+        for name in store.list():
+            print('{}  {} files'.format(name, len(store.load(name))))
+        return
+    name = store.find(args.snapshot)
+    if name is None:
+        print('No snapshot found' if args.snapshot is None else 'No snapshot named ' + args.snapshot)
+        return 1
+    files = store.load(name)
+    print('Rolling back {} files to snapshot {}'.format(len(files), name))
+    if args.dry:
+        for dst, entry in sorted(files.items()):
+            print('Removing' if entry is None else 'Restoring', dst)
+        return
+
+    manifest = Manifest.open_default()
+    # the current files are saved too so the rollback itself can be rolled back
+    snapshot = begin_snapshot(args, manifest)
+    failed = 0
+    try:
+        for dst, entry in sorted(files.items()):
+            snapshot.add(dst, True)
+            if args.verbose:
+                print('Removing' if entry is None else 'Restoring', dst)
+            try:
+                restore_snapshot_file(store, dst, entry)
+            except OSError as e:
+                print('Unable to restore', dst, e)
+                failed += 1
+            manifest.forget(dst)
+    finally:
+        end_snapshot(snapshot, True)
+        manifest.save()
+    return 1 if failed > 0 else 0
+
+
+def handle_bundle(args, plan: Plan):
+    kind = get_bundle_format(args.output)
+    if kind is None:
+        print('Unknown bundle format {}, expected one of .pyz {}'.format(args.output, ' '.join(BUNDLE_TAR_SUFFIXES)))
+        return 2
+    if len(args.classes) > 0:
+        plan = build_plan(plan.source if isinstance(plan.source, Data) else plan.source(), args.classes)
+        render_templates(plan.entries, args.verbose)
+    files = get_bundle_files(plan)
+    manifest = Manifest.open_default()
+    try:
+        bundle_manifest = make_bundle_manifest(files, args.classes if len(args.classes) > 0
+                                               else get_class_setting().get_value(get_config()), manifest, args.jobs)
+    finally:
+        manifest.save()
+    print('Bundling {} files into {}'.format(len(files), args.output))
+    try:
+        write_bundle(args.output, kind, bundle_manifest, files, args.verbose)
+    except OSError as e:
+        print('Unable to write bundle', args.output, e)
+        return 1
 
 
-def handle_print(args, data: Data):
-    run_print_command(args, data)
+def handle_unbundle(args, plan: typing.Optional[Plan]):
+    if get_bundle_format(args.bundle) is None:
+        print('Unknown bundle format', args.bundle)
+        return 2
+    root = os.path.abspath(args.root) if args.root is not None else get_home_folder()
+    try:
+        return unbundle(args, args.bundle, root)
+    except OSError as e:
+        print('Unable to unbundle', args.bundle, e)
+        return 1
 
 
-def handle_uninstall(args, data: Data):
-    remove_command(True, args, data)
+def handle_bench_startup(args, plan: typing.Optional[Plan]):
+    path = args.baseline if args.baseline is not None else default_startup_baseline_path()
+    baseline = {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print('Unable to read baseline', path, e)
+    results = bench_startup(args.tool if len(args.tool) > 0 else list(STARTUP_TOOLS), args.runs)
+    regressions = print_startup_results(results, baseline, args.tolerance, args.threshold, args.top)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print('Saved baseline to', path)
+    if len(regressions) > 0:
+        print('Regressions:', ', '.join(regressions))
+        return 1
+
+
+def handle_daemon(args, plan: Plan):
+    path = get_daemon_socket_path()
+    if args.stop:
+        if query_daemon('stop') is None:
+            print('The daemon is not running')
+            return 1
+        return
+    return StatusDaemon(plan, args.debounce / 1000.0).serve(path)
 
 
-def handle_update(args, data: Data):
-    copy_command(args, data, False)
+def handle_update(args, plan: Plan):
+    copy_command(args, plan, False)
 
 
-def handle_status(args, data: Data):
+def handle_status(args, plan: Plan):
+    if args.format != 'text':
+        return print_file_infos(plan, args.verbose, args.jobs, args.format)
     print('HOME: ', get_home_folder())
     if is_windows():
         print('APPDATA ROAMING: ', get_appdata_roaming_folder())
     print('SRC: ', get_src_folder())
     print()
-    print_file_infos(data, args.verbose)
+    print_file_infos(plan, args.verbose, args.jobs)
 
 
-def handle_home(args, data: Data):
+def handle_home(args, plan: typing.Optional[Plan]):
+    import platform
+    import subprocess
     s = platform.system()
     if s == 'Windows':
         subprocess.call(['explorer', get_home_folder()])
@@ -515,22 +3792,19 @@ def handle_home(args, data: Data):
         print("Unknown OS", s)
 
 
-def handle_class(args, data: Data):
-    c = collections.Counter()
-    for f in data.interesting_files:
-        c = c + collections.Counter(f.classes)
-    existing_classes = frozenset(name for name, count in c.items())
+def handle_class(args, plan: Plan):
+    existing_classes = plan.all_classes()
 
     config = get_config()
 
-    classes = SETTINGS_CLASS.get_value(config)
+    classes = get_class_setting().get_value(config)
 
     if args.value:
         if not args.remove and args.value not in classes:
             classes.append(args.value)
         if args.remove and args.value in classes:
             classes.remove(args.value)
-        SETTINGS_CLASS.set_value(config, classes)
+        get_class_setting().set_value(config, classes)
         config.save()
 
     if len(classes) > 0:
@@ -549,23 +3823,46 @@ def handle_class(args, data: Data):
 
 def has_class(c: str) -> bool:
     config = get_config()
-    values = SETTINGS_CLASS.get_value(config)
+    values = get_class_setting().get_value(config)
     return c in values
 
 
-def handle_diff(args, data: Data):
+def handle_diff(args, plan: Plan):
+    if args.all or args.patch is not None:
+        files = plan.index().search(args.file) if len(args.file) > 0 else plan.active_entries()
+        out, close = open_diff_output(args.patch, not args.no_pager)
+        try:
+            drifted = diff_all(files, args.jobs, out)
+        except BrokenPipeError:
+            # the pager was closed before everything was written
+            drifted = 0
+        finally:
+            close()
+        if args.patch is not None and args.patch != '-':
+            print('Wrote {} diffs to {}'.format(drifted, args.patch))
+        return
+    if len(args.file) == 0:
+        print('Specify a file pattern to diff or use --all')
+        return 2
+
     matches = []
-    for_each_file(data, True, 'diff matches', args.file,
-                  callback_copy=lambda from_path, to_path: matches.append((from_path, to_path)))
+    for_each_file(plan, True, 'diff matches', args.file,
+                  callback_copy=lambda from_path, to_path: matches.append((from_path, to_path)), suggest=False)
     matches = list(set(matches))
+    if len(matches) == 0:
+        suggestions = plan.index().suggest(args.file)
+        if len(suggestions) > 0:
+            print('Using closest match', suggestions[0].home)
+            matches = [(suggestions[0].src, suggestions[0].home)]
+            print_suggestions(suggestions[1:])
     if len(matches) == 1:
         src, home = matches[0]
         call_diff_app(src, home)
     else:
+        if not args.print:
+            print_suggestions(PathIndex.rank(args.file, plan.index().search(args.file))[:10])
         if args.print:
-            for m in matches:
-                src, home, generate = m
-                print("Generated" if generate else "Copied")
+            for src, home in matches:
                 print('Source:', src)
                 print('Home:  ', home)
                 print('')
@@ -574,12 +3871,19 @@ def handle_diff(args, data: Data):
 ########################################################################################################################
 # Main
 
-def main(data: Data):
+def main(data: typing.Union[Data, typing.Callable[[], Data]]):
     parser = argparse.ArgumentParser(description='Manage my dot files.')
+    parser.add_argument('--profile', action='store_true', help='Print time spent per phase when done')
+    parser.add_argument('--trace', metavar='FILE', help='Write one json line per file operation to FILE')
     sub_parsers = parser.add_subparsers(dest='command_name', title='Commands', help='', metavar='<command>')
 
     sub = sub_parsers.add_parser('install', aliases=['copy', 'in', 'co'], help='Copy files to HOME')
     add_copy_commands(sub)
+    add_mode(sub)
+    sub.add_argument('--root', action='append', default=[], metavar='DIR',
+                     help='Install into DIR as if it was HOME instead, can be given several times')
+    sub.add_argument('--bench-startup', type=int, default=0, metavar='RUNS',
+                     help='Time shell and editor startup RUNS times before and after the install')
     sub.set_defaults(func=handle_install)
 
     sub = sub_parsers.add_parser('uninstall', aliases=['remove', 're', 'un'], help='Remove files from HOME')
@@ -588,6 +3892,9 @@ def main(data: Data):
 
     sub = sub_parsers.add_parser('watch', help='watch files for changes and install them')
     add_copy_commands(sub)
+    add_mode(sub)
+    sub.add_argument('--debounce', type=int, default=50,
+                     help='Milliseconds to wait for a burst of saves to settle before installing')
     sub.set_defaults(func=handle_watch)
 
     sub = sub_parsers.add_parser('grab', aliases=['get'], help='Copy files from HOME to git')
@@ -595,9 +3902,15 @@ def main(data: Data):
     sub.set_defaults(func=handle_update)
 
     diff = sub_parsers.add_parser('diff', help='Diff files and stuff')
-    diff.add_argument('file', nargs='+', help='File pattern to diff')
+    diff.add_argument('file', nargs='*', help='File pattern to diff')
     diff.add_argument('-p', '--print', action='store_true', help='Print matches if no exact match was found.')
-    diff.set_defaults(func=handle_diff)
+    diff.add_argument('--all', '-a', action='store_true',
+                      help='Print a unified diff of every drifted file, or every drifted file matching the patterns')
+    diff.add_argument('--patch', metavar='FILE', help='Like --all but write the diffs to FILE, - for stdout')
+    diff.add_argument('--no-pager', action='store_true', help="Don't pipe --all through $PAGER")
+    add_jobs(diff, os.cpu_count() or 4)
+    # keep a patch written to stdout clean
+    diff.set_defaults(func=handle_diff, quiet=lambda a: (a.all and a.patch is None) or a.patch == '-')
 
     sub = sub_parsers.add_parser('print', aliases=['debug'], help='Print generated files')
     sub.add_argument('search', nargs='*', help='selections of file patterns to debug')
@@ -605,10 +3918,58 @@ def main(data: Data):
 
     sub = sub_parsers.add_parser('status', aliases=['stat'], help='List the current status')
     add_verbose(sub)
-    sub.set_defaults(func=handle_status)
+    add_jobs(sub)
+    sub.add_argument('--json', dest='format', action='store_const', const='json', default='text',
+                     help='Print one json record per file and exit with 1 if something has drifted')
+    sub.add_argument('--porcelain', dest='format', action='store_const', const='porcelain',
+                     help='Print state, home and source separated by tabs and exit with 1 if something has drifted')
+    sub.set_defaults(func=handle_status, quiet=lambda a: a.format != 'text')
+
+    sub = sub_parsers.add_parser('rollback', help='Restore the files in HOME from before an install or uninstall')
+    sub.add_argument('snapshot', nargs='?', help='Snapshot to restore, defaults to the latest')
+    sub.add_argument('--list', '-l', action='store_true', help='List the snapshots')
+    add_verbose(sub)
+    add_dry(sub)
+    sub.set_defaults(func=handle_rollback, needs_plan=False)
+
+    sub = sub_parsers.add_parser('bundle', help='Write the files for some classes into a single archive')
+    sub.add_argument('--class', '-c', dest='classes', action='append', default=[], metavar='CLASS',
+                     help='Class to bundle, can be given several times, defaults to the current classes')
+    sub.add_argument('--output', '-o', required=True, metavar='FILE',
+                     help='Archive to write, .tar .tar.gz .tar.xz .tar.zst or a self extracting .pyz')
+    add_verbose(sub)
+    add_jobs(sub, os.cpu_count() or 4)
+    sub.set_defaults(func=handle_bundle)
+
+    sub = sub_parsers.add_parser('unbundle', help='Extract a bundle into HOME and record it as installed')
+    sub.add_argument('bundle', help='Archive written by bundle')
+    sub.add_argument('--root', metavar='DIR', help='Extract into DIR instead of HOME')
+    sub.add_argument('--force', action='store_true', help='Extract files that are already the same')
+    add_verbose(sub)
+    add_dry(sub)
+    sub.set_defaults(func=handle_unbundle, needs_plan=False)
+
+    sub = sub_parsers.add_parser('bench-startup', help='Time zsh, nvim and vim starting with the installed configs')
+    sub.add_argument('--tool', '-t', action='append', default=[], choices=list(STARTUP_TOOLS.keys()),
+                     help='Tool to time, can be given several times, defaults to all that are installed')
+    sub.add_argument('--runs', '-n', type=int, default=10, help='Starts per tool, the median is reported')
+    sub.add_argument('--top', type=int, default=5, help='Number of slowest scripts or functions to list per tool')
+    sub.add_argument('--baseline', metavar='FILE', help='Baseline to compare against, defaults to one in the cache')
+    sub.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    sub.add_argument('--tolerance', type=float, default=STARTUP_TOLERANCE,
+                     help='Allowed slowdown before reporting a regression')
+    sub.add_argument('--threshold', type=float, default=STARTUP_THRESHOLD_MS,
+                     help='Slowdowns of fewer milliseconds are never a regression')
+    sub.set_defaults(func=handle_bench_startup, needs_plan=False)
+
+    sub = sub_parsers.add_parser('daemon', help='Keep the status in memory and answer queries from prompts')
+    sub.add_argument('--stop', action='store_true', help='Stop the running daemon')
+    sub.add_argument('--debounce', type=int, default=50,
+                     help='Milliseconds to wait for a burst of saves to settle before updating')
+    sub.set_defaults(func=handle_daemon)
 
     sub = sub_parsers.add_parser('home', help='Start explorer in home')
-    sub.set_defaults(func=handle_home)
+    sub.set_defaults(func=handle_home, needs_plan=False)
 
     sub = sub_parsers.add_parser('class', help='Get or set the class')
     sub.add_argument('value', nargs='?', help='if specified, add this class')
@@ -617,7 +3978,27 @@ def main(data: Data):
 
     args = parser.parse_args()
     if args.command_name is not None:
-        args.func(args, data)
-        print('Done!')
+        if args.profile or args.trace:
+            PROFILER.start(args.trace is not None)
+        try:
+            plan = None
+            # get_data() is only evaluated, or the cached plan loaded, for commands that look at the files
+            if getattr(args, 'needs_plan', True):
+                with PROFILER.phase('plan'):
+                    plan = build_plan(data) if isinstance(data, Data) else load_plan(data)
+                plan.source = data
+                render_templates(plan.entries, getattr(args, 'verbose', False))
+            with PROFILER.phase('command'):
+                exit_code = args.func(args, plan)
+        finally:
+            if args.trace:
+                PROFILER.write_trace(args.trace)
+            if args.profile:
+                PROFILER.print_summary()
+        # quiet is set by commands whose output can be read by other programs, it decides from the arguments
+        if not getattr(args, 'quiet', lambda a: False)(args):
+            print('Done!')
+        if exit_code:
+            sys.exit(exit_code)
     else:
         parser.print_help()
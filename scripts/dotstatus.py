@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# tiny client for the dotfiles.py daemon, imports nothing from dotlib so it starts fast
+# usage: dotstatus.py [drift-count|status|ping|stop]
+import os
+import sys
+import socket
+
+
+def get_socket_path() -> str:
+    # keep in sync with get_daemon_socket_path() in dotlib.py
+    if os.getenv('DOTLIB_SOCKET'):
+        return os.getenv('DOTLIB_SOCKET')
+    if os.getenv('XDG_RUNTIME_DIR'):
+        return os.path.join(os.getenv('XDG_RUNTIME_DIR'), 'dotlib.sock')
+    cache = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'dotlib', 'daemon.sock')
+
+
+def main():
+    request = sys.argv[1] if len(sys.argv) > 1 else 'drift-count'
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(0.5)
+            client.connect(get_socket_path())
+            client.sendall(request.encode('utf-8') + b'\n')
+            while True:
+                chunk = client.recv(64 * 1024)
+                if not chunk:
+                    break
+                sys.stdout.buffer.write(chunk)
+    except OSError:
+        # the daemon isn't running
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# self extractor for bundles made with dotfiles.py bundle -o home.pyz, stored in the bundle as __main__.py
+# imports nothing from dotlib so a bundle can be extracted on a machine without the dotfiles checkout
+# usage: python3 home.pyz [--root DIR] [--dry]
+# keep the layout in sync with the Bundles section in dotlib.py
+import os
+import sys
+import json
+import hashlib
+import zipfile
+import argparse
+
+MANIFEST = 'dotlib-bundle.json'
+FILES = 'home/'
+
+
+def is_safe(relative: str) -> bool:
+    parts = relative.split('/')
+    return not relative.startswith('/') and all(p not in ('', '.', '..') for p in parts)
+
+
+def extract(bundle: zipfile.ZipFile, name: str, dst: str, record: dict):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    temp = dst + '.dotlib-new'
+    h = hashlib.sha256()
+    with bundle.open(name) as src, open(temp, 'wb') as out:
+        for block in iter(lambda: src.read(1024 * 1024), b''):
+            h.update(block)
+            out.write(block)
+    if h.hexdigest() != record['digest']:
+        os.remove(temp)
+        raise OSError('{} is damaged in the bundle'.format(name))
+    os.chmod(temp, record['mode'])
+    os.replace(temp, dst)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='extract the dotfiles in this bundle')
+    parser.add_argument('--root', default=os.path.expanduser('~'), help='Folder to extract into, defaults to HOME')
+    parser.add_argument('--dry', action='store_true', help="Only list the files that would be extracted")
+    args = parser.parse_args()
+
+    with zipfile.ZipFile(sys.argv[0]) as bundle:
+        with bundle.open(MANIFEST) as f:
+            loaded = json.load(f)
+        print('Extracting {} files for {} into {}'.format(len(loaded['files']), ', '.join(loaded['classes']),
+                                                          args.root))
+        for record in loaded['files']:
+            if not is_safe(record['path']):
+                print('Skipping unsafe path', record['path'])
+                continue
+            dst = os.path.join(args.root, *record['path'].split('/'))
+            print('Extracting', dst)
+            if not args.dry:
+                extract(bundle, FILES + record['path'], dst, record)
+    print('Run dotfiles.py unbundle instead to also record the files in the install manifest')
+
+
+if __name__ == "__main__":
+    main()
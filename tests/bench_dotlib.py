@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# benchmarks for dotlib install/status/grab on a synthesized tree
+# run: python3 tests/bench_dotlib.py --files 5000 --save-baseline
+#      python3 tests/bench_dotlib.py --files 5000
+import sys
+import os
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import statistics
+import typing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dotlib
+
+CLASSES = ['general', 'bench']
+FILES_PER_DIR = 20
+
+
+def dir_names(count: int) -> typing.List[str]:
+    return ['app{:04}'.format(d) for d in range(max(1, count // FILES_PER_DIR))]
+
+
+def file_names() -> typing.List[str]:
+    return ['file{:03}.conf'.format(i) for i in range(FILES_PER_DIR)]
+
+
+def write_tree(src: str, count: int):
+    rng = random.Random(42)
+    shutil.rmtree(src, ignore_errors=True)
+    for name in dir_names(count):
+        folder = os.path.join(src, name, 'conf')
+        os.makedirs(folder)
+        for f in file_names():
+            with open(os.path.join(folder, f), 'wb') as out:
+                out.write(rng.randbytes(rng.randint(100, 4000)))
+
+
+def register_tree(src: str, count: int) -> dotlib.Data:
+    # half of the folders are listed file by file and half are scanned with add_dir
+    data = dotlib.Data()
+    for d, name in enumerate(dir_names(count)):
+        entry = dotlib.Dir([CLASSES[d % len(CLASSES)]], os.path.join(src, name), '.config/' + name)
+        if d % 2 == 0:
+            entry.set_dir('conf')
+            for f in file_names():
+                entry.file(f)
+        else:
+            entry.add_dir('conf')
+        data.add_dir(entry)
+    return data
+
+
+def make_args(jobs: int, **kwargs) -> argparse.Namespace:
+    args = argparse.Namespace(search=[], verbose=False, dry=False, remove=False, force=False, ignore_errors=False,
+                              jobs=jobs, direct=False, mode='copy')
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+class Bench:
+    def __init__(self, root: str, count: int, jobs: int):
+        self.root = root
+        self.count = count
+        self.jobs = jobs
+        self.src = os.path.join(root, 'src')
+        self.home = os.path.join(root, 'home')
+        self.cache = os.path.join(root, 'cache')
+        os.environ['HOME'] = self.home
+        os.environ['XDG_CACHE_HOME'] = self.cache
+        write_tree(self.src, count)
+        self.plan = dotlib.build_plan(register_tree(self.src, count), CLASSES)
+
+    def clear_home(self):
+        shutil.rmtree(self.home, ignore_errors=True)
+        os.makedirs(self.home)
+
+    def clear_cache(self):
+        shutil.rmtree(self.cache, ignore_errors=True)
+
+    def install(self):
+        dotlib.run_copy_command(make_args(self.jobs), self.plan, True)
+
+    def touch_home(self, fraction: float):
+        for f in self.plan.entries[::int(1 / fraction)]:
+            with open(f.home, 'ab') as out:
+                out.write(b'#')
+
+    # (name, setup, run), only run is timed
+    def scenarios(self):
+        def cold():
+            self.clear_home()
+            self.clear_cache()
+
+        def warm():
+            self.clear_cache()
+
+        def nothing():
+            pass
+
+        def drifted():
+            # every round starts from the same sources with a tenth of HOME edited
+            write_tree(self.src, self.count)
+            self.install()
+            self.touch_home(0.1)
+
+        def grab():
+            dotlib.run_copy_command(make_args(self.jobs), self.plan, False)
+
+        def status():
+            dotlib.print_file_infos(self.plan, False, self.jobs)
+
+        def uninstall():
+            dotlib.remove_command(True, make_args(self.jobs), self.plan)
+
+        def diff():
+            terms = dir_names(self.count)[::7] + ['file013', 'missing']
+            for t in terms:
+                dotlib.for_each_file(self.plan, True, 'diff matches', [t], lambda a, b: None)
+
+        return [
+            ('get_data', nothing, lambda: register_tree(self.src, self.count)),
+            ('build plan', nothing, lambda: dotlib.build_plan(register_tree(self.src, self.count), CLASSES)),
+            ('install cold', cold, self.install),
+            ('install warm', warm, self.install),
+            ('install no-op', nothing, self.install),
+            ('status', nothing, status),
+            ('grab', drifted, grab),
+            ('diff matching', nothing, diff),
+            ('uninstall', self.install, uninstall),
+        ]
+
+
+def run_scenario(setup, run, repeat: int):
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            setup()
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    with contextlib.redirect_stdout(io.StringIO()):
+        setup()
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return statistics.median(times), peak
+
+
+def default_baseline() -> str:
+    return os.path.join(dotlib.get_cache_folder(), 'bench-baseline.json')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark dotlib on a synthesized tree')
+    parser.add_argument('--files', type=int, default=2000, help='Number of files to synthesize')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Worker threads for install/grab/status')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario, the median is reported')
+    parser.add_argument('--baseline', default=None, help='Baseline file to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown before reporting a regression')
+    parser.add_argument('--json', action='store_true', help='Print the results as json')
+    args = parser.parse_args()
+
+    baseline_path = args.baseline if args.baseline is not None else default_baseline()
+    baseline = {}
+    if os.path.isfile(baseline_path):
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='dotlib-bench-') as root:
+        bench = Bench(root, args.files, args.jobs)
+        total = len(bench.plan.entries)
+        for name, setup, run in bench.scenarios():
+            seconds, peak = run_scenario(setup, run, args.repeat)
+            results[name] = {
+                'seconds': seconds,
+                'files_per_second': total / seconds if seconds > 0 else 0.0,
+                'peak_bytes': peak,
+                'files': total,
+                'jobs': args.jobs,
+            }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('{:<16} {:>10} {:>14} {:>12} {:>10}'.format('scenario', 'seconds', 'files/second', 'peak KiB',
+                                                          'baseline'))
+    regressions = []
+    for name, r in results.items():
+        change = ''
+        old = baseline.get(name)
+        if old is not None and old['files'] == r['files'] and old.get('jobs') == r['jobs'] \
+                and old['files_per_second'] > 0:
+            ratio = r['files_per_second'] / old['files_per_second']
+            change = '{:+.0f}%'.format((ratio - 1) * 100)
+            if ratio < 1 - args.tolerance:
+                regressions.append(name)
+                change += ' !'
+        if not args.json:
+            print('{:<16} {:>10.4f} {:>14.0f} {:>12.0f} {:>10}'.format(name, r['seconds'], r['files_per_second'],
+                                                                      r['peak_bytes'] / 1024, change))
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print('Saved baseline to', baseline_path)
+
+    if len(regressions) > 0:
+        print('Regressions:', ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
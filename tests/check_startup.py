@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# checks that dotfiles.py starts fast enough to be called from shell hooks, see the startup budget in README.md
+# run: python3 tests/check_startup.py
+#      python3 tests/check_startup.py --import-budget 40 --wall-budget 120
+import sys
+import os
+import argparse
+import subprocess
+import statistics
+import time
+import typing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOTFILES = os.path.join(ROOT, 'dotfiles.py')
+
+COMMANDS = [['--help'], ['class'], ['status', '--porcelain']]
+
+# imported where they are used in dotlib, none of the commands above should need them
+LAZY_MODULES = ['subprocess', 'concurrent.futures', 'filecmp', 'platform', 'hashlib', 'select', 'struct']
+
+
+def get_import_times(command: typing.List[str]) -> typing.List[typing.Tuple[str, int, int]]:
+    """(module, depth, cumulative microseconds) for every import done by the command"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', DOTFILES] + command,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, cwd=ROOT)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            # the header line
+            continue
+        module = name.lstrip(' ')
+        # nested imports are indented two spaces per level and already counted in their parent
+        imports.append((module, (len(name) - len(module) - 1) // 2, int(cumulative)))
+    return imports
+
+
+def get_wall_time(command: typing.List[str], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, DOTFILES] + command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       cwd=ROOT)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='check the cold start of dotfiles.py against a budget')
+    parser.add_argument('--import-budget', type=float, default=50, help='Milliseconds allowed for imports')
+    parser.add_argument('--wall-budget', type=float, default=100, help='Milliseconds allowed for a whole command')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per command, the median is reported')
+    parser.add_argument('--top', type=int, default=5, help='Number of slowest imports to list per command')
+    args = parser.parse_args()
+
+    failed = False
+    for command in COMMANDS:
+        name = ' '.join(command)
+        times = get_import_times(command)
+        top_level = [(module, micros) for module, depth, micros in times if depth == 0]
+        imports = sum(micros for _, micros in top_level) / 1000
+        wall = get_wall_time(command, args.repeat) * 1000
+        eager = [module for module, _, _ in times if module in LAZY_MODULES]
+
+        ok = imports <= args.import_budget and wall <= args.wall_budget and len(eager) == 0
+        failed = failed or not ok
+        print('{:<20} imports {:>6.1f} ms  wall {:>6.1f} ms  {}'.format(name, imports, wall, 'ok' if ok else 'FAILED'))
+        for module, micros in sorted(top_level, key=lambda t: -t[1])[:args.top]:
+            print('    {:<28} {:>6.1f} ms'.format(module, micros / 1000))
+        if len(eager) > 0:
+            print('    should be imported lazily:', ', '.join(eager))
+
+    if failed:
+        print('Startup is over budget, run python3 -X importtime dotfiles.py <command> to see why')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
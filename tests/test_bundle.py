@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# tests for bundle and unbundle, every format is written and extracted again
+# run: python3 -m pytest tests/test_bundle.py
+import sys
+import os
+import io
+import stat
+import shutil
+import argparse
+import tempfile
+import subprocess
+import unittest
+import contextlib
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dotlib
+
+FILES = {
+    '.zshrc': ('zshrc', 'export EDITOR=nvim\n', 0o644),
+    '.config/nvim/init.lua': ('nvim/init.lua', 'require("madeso")\n', 0o644),
+    '.local/bin/hello': ('bin/hello', '#!/bin/sh\necho hello\n', 0o755),
+}
+
+
+def read(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def unbundle_args(**kwargs) -> argparse.Namespace:
+    args = argparse.Namespace(force=False, verbose=False, dry=False)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory(prefix='dotlib-bundle-')
+        root = self.temp.name
+        self.home = os.path.join(root, 'home')
+        self.target = os.path.join(root, 'target')
+        os.makedirs(self.home)
+        self.env = mock.patch.dict(os.environ, {'HOME': self.home, 'XDG_CACHE_HOME': os.path.join(root, 'cache')})
+        self.env.start()
+        entries = []
+        for relative, (src_name, content, mode) in FILES.items():
+            src = os.path.join(root, 'src', src_name)
+            os.makedirs(os.path.dirname(src), exist_ok=True)
+            with open(src, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.chmod(src, mode)
+            entries.append(dotlib.PlanEntry(src, os.path.join(self.home, relative), ['general'], True, None))
+        # outside of HOME, never bundled
+        entries.append(dotlib.PlanEntry(entries[0].src, os.path.join(root, 'outside'), ['general'], True, None))
+        self.plan = dotlib.Plan(entries, ['general'], {}, {})
+        self.quiet = contextlib.redirect_stdout(io.StringIO())
+        self.quiet.__enter__()
+
+    def tearDown(self):
+        self.quiet.__exit__(None, None, None)
+        self.env.stop()
+        self.temp.cleanup()
+
+    def bundle(self, name: str) -> str:
+        path = os.path.join(self.temp.name, name)
+        files = dotlib.get_bundle_files(self.plan)
+        manifest = dotlib.Manifest.open_default()
+        bundle_manifest = dotlib.make_bundle_manifest(files, ['general'], manifest, 1)
+        dotlib.write_bundle(path, dotlib.get_bundle_format(path), bundle_manifest, files, False)
+        return path
+
+    def assert_extracted(self, root: str):
+        for relative, (_, content, mode) in FILES.items():
+            path = os.path.join(root, relative)
+            self.assertEqual(read(path), content)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), mode)
+        self.assertFalse(os.path.exists(os.path.join(root, 'outside')))
+
+    def round_trip(self, name: str):
+        path = self.bundle(name)
+        self.assertEqual(dotlib.unbundle(unbundle_args(), path, self.target), 0)
+        self.assert_extracted(self.target)
+
+    def test_tar(self):
+        self.round_trip('home.tar')
+
+    def test_tar_gz(self):
+        self.round_trip('home.tar.gz')
+
+    def test_tar_xz(self):
+        self.round_trip('home.txz')
+
+    @unittest.skipIf(shutil.which('zstd') is None, 'zstd is not installed')
+    def test_tar_zst(self):
+        self.round_trip('home.tar.zst')
+
+    def test_pyz(self):
+        self.round_trip('home.pyz')
+
+    def test_pyz_extracts_itself(self):
+        path = self.bundle('home.pyz')
+        subprocess.run([sys.executable, path, '--root', self.target], check=True, stdout=subprocess.DEVNULL)
+        self.assert_extracted(self.target)
+
+    def test_unchanged_files_are_not_written(self):
+        path = self.bundle('home.tar')
+        dotlib.unbundle(unbundle_args(), path, self.target)
+        zshrc = os.path.join(self.target, '.zshrc')
+        before = os.stat(zshrc).st_ino
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            dotlib.unbundle(unbundle_args(), path, self.target)
+        self.assertIn('0 written, 3 unchanged', out.getvalue())
+        self.assertEqual(os.stat(zshrc).st_ino, before)
+
+    def test_dry_run_writes_nothing(self):
+        path = self.bundle('home.tar.gz')
+        dotlib.unbundle(unbundle_args(dry=True), path, self.target)
+        self.assertFalse(os.path.exists(self.target))
+
+    def test_unbundled_files_are_recorded(self):
+        path = self.bundle('home.tar')
+        dotlib.unbundle(unbundle_args(), path, self.home)
+        manifest = dotlib.Manifest.open_default()
+        for e in self.plan.entries[:len(FILES)]:
+            self.assertTrue(manifest.is_unchanged(e.src, e.home))
+
+    def test_unsafe_paths(self):
+        self.assertTrue(dotlib.is_safe_bundle_path('.config/nvim/init.lua'))
+        for relative in ['/etc/passwd', '../outside', '.config/../../outside', 'a//b', './a']:
+            self.assertFalse(dotlib.is_safe_bundle_path(relative), relative)
+
+    def test_bundle_format(self):
+        self.assertEqual(dotlib.get_bundle_format('home.PYZ'), 'pyz')
+        self.assertEqual(dotlib.get_bundle_format('home.tgz'), 'gz')
+        self.assertEqual(dotlib.get_bundle_format('home.tar'), '')
+        self.assertIsNone(dotlib.get_bundle_format('home.zip'))
+
+
+if __name__ == "__main__":
+    unittest.main()
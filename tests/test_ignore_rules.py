@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# tests for the .gitignore style rules used when Dir.add_dir() scans a folder
+# run: python3 -m pytest tests/test_ignore_rules.py
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dotlib
+
+
+def make_rules(*patterns: str, base: str = '') -> dotlib.IgnoreRules:
+    rules = dotlib.IgnoreRules()
+    for p in patterns:
+        rules.add(p, base)
+    return rules
+
+
+class IgnoreRulesTest(unittest.TestCase):
+    def test_floating_pattern_matches_at_any_depth(self):
+        rules = make_rules('*.pyc')
+        self.assertTrue(rules.is_ignored('a.pyc', False))
+        self.assertTrue(rules.is_ignored('lua/madeso/a.pyc', False))
+        self.assertFalse(rules.is_ignored('a.py', False))
+
+    def test_anchored_pattern_only_matches_from_the_base(self):
+        rules = make_rules('/build', 'doc/*.txt')
+        self.assertTrue(rules.is_ignored('build', True))
+        self.assertFalse(rules.is_ignored('src/build', True))
+        self.assertTrue(rules.is_ignored('doc/a.txt', False))
+        self.assertFalse(rules.is_ignored('plugin/doc/a.txt', False))
+        # * doesn't cross folders
+        self.assertFalse(rules.is_ignored('doc/sub/a.txt', False))
+
+    def test_double_star(self):
+        rules = make_rules('doc/**/tags')
+        self.assertTrue(rules.is_ignored('doc/tags', False))
+        self.assertTrue(rules.is_ignored('doc/a/b/tags', False))
+        self.assertFalse(rules.is_ignored('other/tags', False))
+
+    def test_negation_includes_again(self):
+        rules = make_rules('*.log', '!keep.log')
+        self.assertTrue(rules.is_ignored('a.log', False))
+        self.assertFalse(rules.is_ignored('keep.log', False))
+        self.assertFalse(rules.is_ignored('sub/keep.log', False))
+        # the last matching pattern wins
+        rules = make_rules('!keep.log', '*.log')
+        self.assertTrue(rules.is_ignored('keep.log', False))
+
+    def test_directory_only_pattern(self):
+        rules = make_rules('cache/')
+        self.assertTrue(rules.is_ignored('cache', True))
+        self.assertTrue(rules.is_ignored('a/cache', True))
+        self.assertFalse(rules.is_ignored('cache', False))
+
+    def test_comments_and_blank_lines(self):
+        rules = make_rules('# *.txt', '', '   ')
+        self.assertEqual(rules.rules, [])
+        self.assertFalse(rules.is_ignored('a.txt', False))
+
+    def test_per_directory_base(self):
+        # patterns read from plugin/.gitignore only apply inside plugin
+        rules = make_rules('*.tmp', '/local', base='plugin')
+        self.assertTrue(rules.is_ignored('plugin/a.tmp', False))
+        self.assertTrue(rules.is_ignored('plugin/sub/a.tmp', False))
+        self.assertFalse(rules.is_ignored('a.tmp', False))
+        self.assertFalse(rules.is_ignored('other/a.tmp', False))
+        self.assertTrue(rules.is_ignored('plugin/local', True))
+        self.assertFalse(rules.is_ignored('plugin/sub/local', True))
+
+    def test_character_class_and_question_mark(self):
+        rules = make_rules('file[0-9].?')
+        self.assertTrue(rules.is_ignored('file1.c', False))
+        self.assertFalse(rules.is_ignored('filex.c', False))
+        self.assertFalse(rules.is_ignored('file1.cc', False))
+
+
+if __name__ == "__main__":
+    unittest.main()
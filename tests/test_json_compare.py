@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# tests for comparing json settings by content, see compare='json' in dotfiles.py
+# run: python3 -m pytest tests/test_json_compare.py
+import sys
+import os
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dotlib
+
+
+class StripJsonCommentsTest(unittest.TestCase):
+    def parse(self, text: str):
+        return json.loads(dotlib.strip_json_comments(text))
+
+    def test_line_and_block_comments(self):
+        text = '{\n  // a comment\n  "a": 1, /* block\n comment */ "b": 2\n}'
+        self.assertEqual(self.parse(text), {'a': 1, 'b': 2})
+
+    def test_trailing_commas(self):
+        self.assertEqual(self.parse('{"a": [1, 2, ],\n "b": {"c": 3,\n},\n}'), {'a': [1, 2], 'b': {'c': 3}})
+
+    def test_comment_markers_in_strings_are_kept(self):
+        text = '{"url": "http://example.com/*x*/", "s": "a, }"}'
+        self.assertEqual(self.parse(text), {'url': 'http://example.com/*x*/', 's': 'a, }'})
+
+    def test_escaped_quotes(self):
+        self.assertEqual(self.parse('{"a": "say \\"hi\\" // not a comment"}'), {'a': 'say "hi" // not a comment'})
+
+    def test_unterminated_comment_runs_to_the_end(self):
+        self.assertEqual(self.parse('{"a": 1} // end'), {'a': 1})
+        self.assertEqual(self.parse('{"a": 1} /* end'), {'a': 1})
+
+
+class RemoveJsonKeysTest(unittest.TestCase):
+    def test_top_level_key(self):
+        value = {'$schema': 'x', 'a': 1}
+        dotlib.remove_json_keys(value, ['$schema'])
+        self.assertEqual(value, {'a': 1})
+
+    def test_nested_path_and_missing_key(self):
+        value = {'a': {'b': 1, 'c': 2}}
+        dotlib.remove_json_keys(value, ['a', 'b'])
+        dotlib.remove_json_keys(value, ['a', 'missing', 'x'])
+        self.assertEqual(value, {'a': {'c': 2}})
+
+    def test_wildcard_in_dict_and_list(self):
+        value = {'profiles': [{'guid': 1, 'name': 'a'}, {'guid': 2, 'name': 'b'}]}
+        dotlib.remove_json_keys(value, ['profiles', '*', 'guid'])
+        self.assertEqual(value, {'profiles': [{'name': 'a'}, {'name': 'b'}]})
+
+        value = {'a': {'x': 1}, 'b': {'x': 2, 'y': 3}}
+        dotlib.remove_json_keys(value, ['*', 'x'])
+        self.assertEqual(value, {'a': {}, 'b': {'y': 3}})
+
+    def test_list_index(self):
+        value = {'a': [1, 2, 3]}
+        dotlib.remove_json_keys(value, ['a', '1'])
+        dotlib.remove_json_keys(value, ['a', '9'])
+        self.assertEqual(value, {'a': [1, 3]})
+
+
+class CanonicalJsonTest(unittest.TestCase):
+    def test_formatting_order_and_ignored_keys_do_not_matter(self):
+        with tempfile.TemporaryDirectory(prefix='dotlib-json-') as root:
+            lhs = os.path.join(root, 'lhs.json')
+            rhs = os.path.join(root, 'rhs.json')
+            with open(lhs, 'w', encoding='utf-8') as f:
+                f.write('{\n  // settings\n  "b": [1, 2,],\n  "a": true,\n  "$help": "one"\n}\n')
+            with open(rhs, 'w', encoding='utf-8-sig') as f:
+                f.write('{"a":true,"b":[1,2],"$help":"two"}')
+            ignore = ['$help']
+            self.assertEqual(dotlib.get_canonical_json(lhs, ignore), dotlib.get_canonical_json(rhs, ignore))
+            self.assertNotEqual(dotlib.get_canonical_json(lhs, []), dotlib.get_canonical_json(rhs, []))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# tests for the digest cache and the install manifest that let a run skip files without reading them
+# run: python3 -m pytest tests/test_manifest.py
+import sys
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dotlib
+
+
+def write(path: str, content: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+
+def set_mtime(path: str, mtime_ns: int):
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+class DigestCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory(prefix='dotlib-digest-')
+        self.root = self.temp.name
+        self.path = os.path.join(self.root, 'digests.json')
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def file(self, name: str, content: str) -> str:
+        path = os.path.join(self.root, name)
+        write(path, content)
+        return path
+
+    def test_digest_is_cached_until_the_file_changes(self):
+        a = self.file('a', 'one')
+        cache = dotlib.DigestCache(self.path)
+        first = cache.digest(a)
+        self.assertEqual(first, dotlib.file_digest(a))
+        self.assertEqual(cache.digest(a), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        write(a, 'two')
+        set_mtime(a, os.stat(a).st_mtime_ns + 1000000000)
+        self.assertEqual(cache.digest(a), dotlib.file_digest(a))
+        self.assertEqual(cache.misses, 2)
+
+    def test_saved_and_loaded(self):
+        a = self.file('a', 'one')
+        cache = dotlib.DigestCache(self.path)
+        digest = cache.digest(a)
+        cache.save()
+        loaded = dotlib.DigestCache(self.path)
+        self.assertEqual(loaded.digest(a), digest)
+        self.assertEqual((loaded.hits, loaded.misses), (1, 0))
+
+    def test_prune_drops_paths_not_kept(self):
+        a = self.file('a', 'one')
+        b = self.file('b', 'two')
+        cache = dotlib.DigestCache(self.path)
+        cache.digest(a)
+        cache.digest(b)
+        cache.dirty = False
+        cache.prune(frozenset([a]))
+        self.assertEqual(list(cache.entries), [a])
+        self.assertTrue(cache.dirty)
+
+    def test_prune_evicts_the_oldest_over_the_limit(self):
+        paths = [self.file(str(i), str(i)) for i in range(5)]
+        cache = dotlib.DigestCache(self.path)
+        for p in paths:
+            cache.digest(p)
+        with mock.patch.object(dotlib.DigestCache, 'MAX_ENTRIES', 3):
+            cache.prune(frozenset(paths))
+        self.assertEqual(list(cache.entries), paths[2:])
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory(prefix='dotlib-manifest-')
+        self.root = self.temp.name
+        self.src = os.path.join(self.root, 'src')
+        self.dst = os.path.join(self.root, 'dst')
+        write(self.src, 'content')
+        write(self.dst, 'content')
+        self.manifest = dotlib.Manifest(os.path.join(self.root, 'manifest.json'),
+                                        dotlib.DigestCache(os.path.join(self.root, 'digests.json')))
+        self.manifest.record(self.src, self.dst)
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_unchanged_after_record(self):
+        self.assertTrue(self.manifest.is_unchanged(self.src, self.dst))
+
+    def test_unknown_pair(self):
+        other = os.path.join(self.root, 'other')
+        write(other, 'content')
+        self.assertFalse(self.manifest.is_unchanged(other, self.dst))
+        self.assertFalse(self.manifest.is_unchanged(self.src, other))
+
+    def test_edited_destination(self):
+        write(self.dst, 'edited in home')
+        self.assertFalse(self.manifest.is_unchanged(self.src, self.dst))
+
+    def test_touched_source_with_the_same_content(self):
+        # a checkout touches the file without changing it
+        set_mtime(self.src, os.stat(self.src).st_mtime_ns + 1000000000)
+        self.assertTrue(self.manifest.is_unchanged(self.src, self.dst))
+        # the new mtime is remembered so the next check needs no digest
+        self.assertEqual(self.manifest.entries[self.dst]['src_mtime'], os.stat(self.src).st_mtime_ns)
+
+    def test_changed_source(self):
+        write(self.src, 'changed')
+        set_mtime(self.src, os.stat(self.src).st_mtime_ns + 1000000000)
+        self.assertFalse(self.manifest.is_unchanged(self.src, self.dst))
+
+    def test_symlinked_destination(self):
+        os.remove(self.dst)
+        os.symlink(self.src, self.dst)
+        self.manifest.record(self.src, self.dst)
+        self.assertFalse(self.manifest.is_unchanged(self.src, self.dst))
+
+    def test_saved_and_loaded(self):
+        self.manifest.save()
+        loaded = dotlib.Manifest(self.manifest.path)
+        self.assertTrue(loaded.is_unchanged(self.src, self.dst))
+
+    def test_prune_keeps_the_digests_of_the_plan(self):
+        other = os.path.join(self.root, 'other')
+        write(other, 'other')
+        self.manifest.digest(other)
+        plan = dotlib.Plan([dotlib.PlanEntry(self.src, self.dst, ['general'], True, None)], ['general'], {}, {})
+        self.manifest.prune(plan)
+        self.assertIn(self.src, self.manifest.digests.entries)
+        self.assertNotIn(other, self.manifest.digests.entries)
+
+
+if __name__ == "__main__":
+    unittest.main()
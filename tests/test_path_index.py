@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# tests for searching the plan and suggesting files for search terms with typos
+# run: python3 -m pytest tests/test_path_index.py
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dotlib
+
+
+def make_entries() -> dotlib.PathIndex:
+    files = [
+        ('/src/zshrc', '/home/.zshrc'),
+        ('/src/vimrc', '/home/.vimrc'),
+        ('/src/nvim/init.lua', '/home/.config/nvim/init.lua'),
+        ('/src/nvim/lua/madeso/colorscheme.lua', '/home/.config/nvim/lua/madeso/colorscheme.lua'),
+        ('/src/kitty/kitty.conf', '/home/.config/kitty/kitty.conf'),
+        ('/src/tigrc', '/home/.tigrc'),
+        ('/src/init/a.conf', '/home/.config/init/a.conf'),
+    ]
+    return dotlib.PathIndex([dotlib.PlanEntry(src, home, ['general'], True, None) for src, home in files])
+
+
+class LevenshteinTest(unittest.TestCase):
+    def test_distance(self):
+        self.assertEqual(dotlib.levenshtein_distance('kitten', 'sitting'), 3)
+        self.assertEqual(dotlib.levenshtein_distance('', 'abc'), 3)
+        self.assertEqual(dotlib.levenshtein_distance('same', 'same'), 0)
+        self.assertEqual(dotlib.levenshtein_distance('abc', 'ab'), dotlib.levenshtein_distance('ab', 'abc'))
+
+    def test_limit(self):
+        # within the limit the real distance is returned
+        self.assertEqual(dotlib.levenshtein_distance('kitten', 'sitting', 3), 3)
+        # above it, limit + 1 no matter how far off
+        self.assertEqual(dotlib.levenshtein_distance('kitten', 'sitting', 1), 2)
+        self.assertEqual(dotlib.levenshtein_distance('a', 'abcdefgh', 2), 3)
+        self.assertEqual(dotlib.levenshtein_distance('abcdefgh', 'zyxwvuts', 2), 3)
+
+
+class PathIndexTest(unittest.TestCase):
+    def test_search(self):
+        index = make_entries()
+        self.assertEqual([e.src for e in index.search(['zshrc'])], ['/src/zshrc'])
+        self.assertEqual([e.src for e in index.search(['nvim', 'color'])], ['/src/nvim/lua/madeso/colorscheme.lua'])
+        # short terms can't use the trigrams and fall back to a scan
+        self.assertEqual([e.src for e in index.search(['sh'])], ['/src/zshrc'])
+        self.assertEqual(index.search(['missing']), [])
+        self.assertEqual(len(index.search([])), 7)
+
+    def test_suggest_typo(self):
+        index = make_entries()
+        self.assertEqual(index.suggest(['zshc'])[0].src, '/src/zshrc')
+        self.assertEqual(index.suggest(['kity'])[0].src, '/src/kitty/kitty.conf')
+        self.assertEqual(index.suggest(['colorshceme'])[0].src, '/src/nvim/lua/madeso/colorscheme.lua')
+
+    def test_suggest_file_name_before_folder(self):
+        index = make_entries()
+        # init is the name of init.lua and only a folder of a.conf
+        self.assertEqual([e.src for e in index.suggest(['initt'])], ['/src/nvim/init.lua', '/src/init/a.conf'])
+
+    def test_suggest_only_looks_at_close_folders(self):
+        index = make_entries()
+        # nvim is two folders above colorscheme.lua
+        self.assertEqual([e.src for e in index.suggest(['nvm'])], ['/src/nvim/init.lua'])
+
+    def test_transposition_is_two_edits(self):
+        index = make_entries()
+        # a five letter term allows one edit
+        self.assertEqual(index.suggest(['zhsrc']), [])
+
+    def test_suggest_nothing_close(self):
+        index = make_entries()
+        self.assertEqual(index.suggest(['qqqqqqqq']), [])
+
+    def test_suggest_count(self):
+        index = make_entries()
+        # .config is a close folder of three files
+        self.assertEqual(len(index.suggest(['config'])), 3)
+        self.assertEqual(len(index.suggest(['config'], 2)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
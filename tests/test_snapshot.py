@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# tests for the snapshots taken before dotlib changes HOME and for rollback
+# run: python3 -m pytest tests/test_snapshot.py
+import sys
+import os
+import io
+import argparse
+import tempfile
+import unittest
+import contextlib
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dotlib
+
+
+def read(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def write(path: str, content: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+
+def rollback_args() -> argparse.Namespace:
+    return argparse.Namespace(list=False, snapshot=None, dry=False, verbose=False)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory(prefix='dotlib-snapshot-')
+        root = self.temp.name
+        self.home = os.path.join(root, 'home')
+        os.makedirs(self.home)
+        self.env = mock.patch.dict(os.environ, {'HOME': self.home, 'XDG_CACHE_HOME': os.path.join(root, 'cache')})
+        self.env.start()
+        self.src = os.path.join(root, 'vimrc')
+        self.dst = os.path.join(self.home, '.vimrc')
+        write(self.src, 'new')
+        self.manifest = dotlib.Manifest.open_default()
+        self.quiet = contextlib.redirect_stdout(io.StringIO())
+        self.quiet.__enter__()
+
+    def tearDown(self):
+        self.quiet.__exit__(None, None, None)
+        self.env.stop()
+        self.temp.cleanup()
+
+    def install(self, success: bool = True) -> dotlib.Snapshot:
+        """install src over dst in a transaction, like install without --direct"""
+        transaction = dotlib.Transaction(dotlib.Transaction.default_journal_path(), self.manifest)
+        snapshot = dotlib.Snapshot(dotlib.SnapshotStore(dotlib.SnapshotStore.default_path()), self.manifest)
+        dotlib.file_copy(self.src, self.dst, False, True, False, False, False, self.manifest, 'copy', transaction,
+                         snapshot)
+        dotlib.end_transaction(transaction, success)
+        dotlib.end_snapshot(snapshot, False)
+        return snapshot
+
+    def test_rollback_restores_file(self):
+        write(self.dst, 'old')
+        self.install()
+        self.assertEqual(read(self.dst), 'new')
+        self.assertEqual(dotlib.handle_rollback(rollback_args(), None), 0)
+        self.assertEqual(read(self.dst), 'old')
+
+    def test_rollback_restores_symlink(self):
+        target = os.path.join(self.temp.name, 'linked')
+        write(target, 'linked')
+        os.symlink(target, self.dst)
+        self.install()
+        self.assertFalse(os.path.islink(self.dst))
+        self.assertEqual(dotlib.handle_rollback(rollback_args(), None), 0)
+        self.assertTrue(os.path.islink(self.dst))
+        self.assertEqual(os.readlink(self.dst), target)
+
+    def test_rollback_removes_new_file(self):
+        self.install()
+        self.assertEqual(dotlib.handle_rollback(rollback_args(), None), 0)
+        self.assertFalse(os.path.lexists(self.dst))
+
+    def test_aborted_install_is_not_snapshotted(self):
+        write(self.dst, 'old')
+        snapshot = self.install(False)
+        self.assertEqual(read(self.dst), 'old')
+        self.assertEqual(snapshot.files, {})
+        # the file in HOME must not share its inode with the store
+        self.assertEqual(os.stat(self.dst).st_nlink, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
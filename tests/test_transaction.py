@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# tests for the staged install in dotlib, a failed or interrupted commit must leave the previous files in place
+# run: python3 -m pytest tests/test_transaction.py
+#      python3 tests/test_transaction.py
+import sys
+import os
+import errno
+import tempfile
+import subprocess
+import unittest
+import contextlib
+import io
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import dotlib
+
+
+def read(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def write(path: str, content: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+
+# commits two staged files in a new process that dies, without any cleanup, at the second rename
+CRASH = '''
+import os
+import sys
+sys.path.insert(0, {root!r})
+import dotlib
+transaction = dotlib.Transaction({journal!r}, None, dotlib.DirectoryHandles({handles!r}))
+for src, dst in {files!r}:
+    transaction.stage(src, dst, dotlib.install_copy)
+replace = os.replace
+renames = []
+def crash(a, b, **kwargs):
+    renames.append(b)
+    if len(renames) == 2:
+        os._exit(3)
+    replace(a, b, **kwargs)
+os.replace = crash
+transaction.commit()
+'''
+
+# stages two files in a new process that dies before the commit writes its journal
+CRASH_STAGED = '''
+import os
+import sys
+sys.path.insert(0, {root!r})
+import dotlib
+transaction = dotlib.Transaction({journal!r}, None, dotlib.DirectoryHandles({handles!r}))
+for src, dst in {files!r}:
+    transaction.stage(src, dst, dotlib.install_copy)
+os._exit(3)
+'''
+
+
+class FakeManifest:
+    def __init__(self):
+        self.recorded = []
+
+    def record(self, src: str, dst: str):
+        self.recorded.append(dst)
+
+
+class TransactionTest(unittest.TestCase):
+    # the files are written by full path, like on windows
+    USE_HANDLES = False
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory(prefix='dotlib-transaction-')
+        self.root = self.temp.name
+        self.journal = os.path.join(self.root, 'journal.json')
+        self.files = []
+        for name in ['a', 'b']:
+            src = os.path.join(self.root, 'src-' + name)
+            dst = os.path.join(self.root, 'home-' + name)
+            write(src, 'new ' + name)
+            write(dst, 'old ' + name)
+            self.files.append((src, dst))
+        self.handles = dotlib.DirectoryHandles(self.USE_HANDLES)
+
+    def tearDown(self):
+        self.handles.close()
+        self.temp.cleanup()
+
+    def transaction(self, manifest=None) -> dotlib.Transaction:
+        return dotlib.Transaction(self.journal, manifest, self.handles)
+
+    def stage_all(self, transaction: dotlib.Transaction, record: bool = True):
+        for src, dst in self.files:
+            transaction.stage(src, dst, dotlib.install_copy, record)
+
+    def assert_contents(self, prefix: str):
+        for name, (_, dst) in zip(['a', 'b'], self.files):
+            self.assertEqual(read(dst), prefix + name)
+
+    def assert_clean(self):
+        self.assertEqual(sorted(os.listdir(self.root)), ['home-a', 'home-b', 'src-a', 'src-b'])
+
+    def test_commit_replaces_files(self):
+        transaction = self.transaction()
+        self.stage_all(transaction)
+        transaction.commit()
+        self.assert_contents('new ')
+        self.assert_clean()
+
+    def test_failed_commit_restores_files(self):
+        transaction = self.transaction()
+        self.stage_all(transaction)
+        replace = os.replace
+        renames = []
+
+        def fail(a, b, **kwargs):
+            renames.append(b)
+            if len(renames) == 2:
+                raise OSError(errno.EIO, 'failed rename')
+            replace(a, b, **kwargs)
+
+        with mock.patch('os.replace', fail), contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(OSError):
+                transaction.commit()
+        self.assert_contents('old ')
+        self.assert_clean()
+
+    def test_recover_after_interrupted_commit(self):
+        script = CRASH.format(root=ROOT, journal=self.journal, files=self.files, handles=self.USE_HANDLES)
+        result = subprocess.run([sys.executable, '-c', script])
+        self.assertEqual(result.returncode, 3)
+        # the first file was renamed into place and the journal is left behind
+        self.assertEqual(read(self.files[0][1]), 'new a')
+        self.assertTrue(os.path.exists(self.journal))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            dotlib.Transaction(self.journal).recover()
+        self.assert_contents('old ')
+        self.assert_clean()
+
+    def test_recover_after_crash_while_staging(self):
+        script = CRASH_STAGED.format(root=ROOT, journal=self.journal, files=self.files, handles=self.USE_HANDLES)
+        result = subprocess.run([sys.executable, '-c', script])
+        self.assertEqual(result.returncode, 3)
+        self.assertTrue(os.path.exists(self.files[0][1] + dotlib.Transaction.NEW_SUFFIX))
+
+        dotlib.Transaction(self.journal).recover()
+        self.assert_contents('old ')
+        self.assert_clean()
+
+    def test_backup_without_hardlinks(self):
+        transaction = self.transaction()
+        self.stage_all(transaction)
+        with mock.patch('os.link', side_effect=OSError(errno.EOPNOTSUPP, 'not supported')):
+            transaction.commit()
+        self.assert_contents('new ')
+        self.assert_clean()
+
+    def test_link_installs_are_not_recorded(self):
+        manifest = FakeManifest()
+        transaction = self.transaction(manifest)
+        self.stage_all(transaction, False)
+        transaction.commit()
+        self.assertEqual(manifest.recorded, [])
+
+
+@unittest.skipUnless(dotlib.DirectoryHandles().use_handles, 'no dir_fd support')
+class TransactionWithHandlesTest(TransactionTest):
+    # the files are written and renamed relative to the handles of their folders
+    USE_HANDLES = True
+
+    def test_staged_relative_to_the_folder(self):
+        transaction = self.transaction()
+        opened = []
+        open_file = os.open
+
+        def record(path, flags, mode=0o777, **kwargs):
+            opened.append((path, kwargs.get('dir_fd')))
+            return open_file(path, flags, mode, **kwargs)
+
+        with mock.patch('os.open', record):
+            self.stage_all(transaction)
+        folder_fd = self.handles.open_folder(self.root)
+        self.assertIn(('home-a' + dotlib.Transaction.NEW_SUFFIX, folder_fd), opened)
+        transaction.commit()
+        self.assert_contents('new ')
+        self.assert_clean()
+
+
+if __name__ == "__main__":
+    unittest.main()